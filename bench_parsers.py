@@ -0,0 +1,142 @@
+"""
+Benchmark y verificación offline de los parsers sobre fixtures/.
+
+    python bench_parsers.py               # verifica salidas y mide
+    python bench_parsers.py --actualizar  # regenera fixtures/esperado.json
+
+Sale con código 1 si algún parser deja de producir la salida esperada o si
+los niveles de extracción no coinciden entre sí.
+
+Las páginas de fixtures/ son sintéticas: reproducen el marcado del sitio
+(meta price, #productPrice, span.priceText, stockFlag, "Agotado", búsqueda
+sin resultados, listados paginados) con cabecera, menú y pie de tamaño realista. La columna
+"KiB pico" es memoria Python medida con tracemalloc; lo que reserva libxml2
+internamente no aparece ahí.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import scraper_cyberpuerta as sc
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+EXPECTED_FILE = os.path.join(FIXTURES_DIR, "esperado.json")
+SEARCH_BASE_URL = "https://www.cyberpuerta.mx/index.php?cl=search&searchparam=FIXTURE"
+
+PRICE_SAMPLES = ["$1,299.00", "$ 89.00 MXN", "1199.00", "$\xa0199.00", "", "Consultar"]
+
+
+def load_fixtures():
+    pages = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith(".html"):
+            with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+                pages[name] = f.read()
+    return pages
+
+
+def parse_fixture(name, html):
+    if name.startswith("busqueda_"):
+        return {"busqueda": sc.parse_first_product_url_from_search(html, SEARCH_BASE_URL)}
+    if name.startswith("detalle_"):
+        return {"detalle": list(sc.extract_all_from_product(html))}
+    if name.startswith("listado_"):
+        return {
+            "listado": sc.parse_listing_products(html, SEARCH_BASE_URL),
+            "siguiente": sc.parse_next_page_url(html, SEARCH_BASE_URL),
+        }
+    return {}
+
+
+def measure(fn, arg, min_seconds=0.5):
+    """Devuelve (llamadas/s, KiB pico asignados por llamada)."""
+    fn(arg)
+    n, t0 = 0, time.perf_counter()
+    while True:
+        fn(arg)
+        n += 1
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_seconds:
+            break
+    tracemalloc.start()
+    fn(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return n / elapsed, peak / 1024.0
+
+
+def verify(pages, expected):
+    failures = []
+    for name, html in pages.items():
+        got = parse_fixture(name, html)
+        if name not in expected:
+            failures.append(f"{name}: sin salida esperada (corre con --actualizar)")
+        elif got != expected[name]:
+            failures.append(f"{name}: esperado {expected[name]}, obtenido {got}")
+        if name.startswith("detalle_"):
+            soup = sc._extract_all_from_product_soup(html)
+            _, fast = sc._extract_all_from_product_lxml(html)
+            if soup != fast:
+                failures.append(f"{name}: nivel lxml {fast} != nivel soup {soup}")
+    return failures
+
+
+def bench(pages, min_seconds):
+    print(f"{'parser':<34}{'fixture':<40}{'pág/s':>10}{'KiB pico':>12}")
+    for name, html in pages.items():
+        if name.startswith("busqueda_"):
+            rows = [
+                ("busqueda", lambda h: sc.parse_first_product_url_from_search(h, SEARCH_BASE_URL)),
+                ("listado", lambda h: sc.parse_listing_products(h, SEARCH_BASE_URL)),
+            ]
+        elif name.startswith("listado_"):
+            rows = [("listado", lambda h: sc.parse_listing_products(h, SEARCH_BASE_URL))]
+        else:
+            tier, _ = sc._extract_all_from_product_lxml(html)
+            rows = [
+                ("detalle/soup", sc._extract_all_from_product_soup),
+                (f"detalle/lxml ({tier})", sc.extract_all_from_product),
+            ]
+        for label, fn in rows:
+            rate, kib = measure(fn, html, min_seconds)
+            print(f"{label:<34}{name:<40}{rate:>10.1f}{kib:>12.1f}")
+    for sample in PRICE_SAMPLES:
+        rate, kib = measure(sc.to_number, sample, min_seconds / 5)
+        print(f"{'to_number':<34}{repr(sample):<40}{rate:>10.0f}{kib:>12.1f}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--actualizar", action="store_true", help="regenera fixtures/esperado.json")
+    ap.add_argument("--solo-verificar", action="store_true", help="no mide, sólo compara salidas")
+    ap.add_argument("--segundos", type=float, default=0.5, help="tiempo mínimo de medición por caso")
+    args = ap.parse_args(argv)
+
+    pages = load_fixtures()
+    if args.actualizar:
+        expected = {name: parse_fixture(name, html) for name, html in pages.items()}
+        with open(EXPECTED_FILE, "w", encoding="utf-8") as f:
+            json.dump(expected, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"✅ '{EXPECTED_FILE}' actualizado con {len(expected)} fixtures.")
+        return 0
+
+    with open(EXPECTED_FILE, encoding="utf-8") as f:
+        expected = json.load(f)
+    failures = verify(pages, expected)
+    for msg in failures:
+        print(f"❌ {msg}")
+    if failures:
+        return 1
+    print(f"✅ {len(pages)} fixtures producen la salida esperada.\n")
+
+    if not args.solo_verificar:
+        bench(pages, args.segundos)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Benchmark de punta a punta contra el sitio simulado (mock_cyberpuerta.py).
+
+    python bench_pipeline.py --perfil sitio --items 200 --escala 0.01
+    python bench_pipeline.py --perfil hostil --workers 3 --escala 0.005
+
+Corre main() completo (journal, sink CSV, xlsx, deltas) sobre SKUs
+sintéticos en una carpeta temporal, con su propia base de estado. Reporta
+ítems/hora, tasa de éxito y cuánto del tiempo de los ítems se fue en
+backoff y en esperas intencionales.
+
+--escala comprime el tiempo: el scraper y el servidor ven un reloj virtual
+(time.sleep dura escala veces lo pedido y time.time/monotonic avanzan
+1/escala más rápido), así que los tiempos reportados están en segundos del
+sitio. El trabajo de CPU (parseo, SQLite) sí se infla 1/escala: para
+medirlo sin distorsión está bench_parsers.py.
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+from mock_cyberpuerta import PROFILES, MockSite
+
+
+class ScaledTime:
+    """Sustituto del módulo time con reloj virtual."""
+
+    def __init__(self, escala):
+        self.escala = escala
+        self._t0_real = time.monotonic()
+        self._t0_wall = time.time()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def _virtual(self):
+        return (time.monotonic() - self._t0_real) / self.escala
+
+    def sleep(self, seconds):
+        time.sleep(max(0.0, seconds) * self.escala)
+
+    def monotonic(self):
+        return self._t0_real + self._virtual()
+
+    def time(self):
+        return self._t0_wall + self._virtual()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--perfil", choices=sorted(PROFILES), default="sitio")
+    ap.add_argument("--items", type=int, default=100, help="SKUs sintéticos a procesar")
+    ap.add_argument("--escala", type=float, default=0.01, help="factor de tiempo (0.01 = 100 veces más rápido)")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--semilla", type=int, default=0)
+    ap.add_argument("--max-horas", type=float, default=0.0, help="límite de la corrida en horas del sitio (0 = sin límite)")
+    args = ap.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    os.environ["CYBERPUERTA_STATE_DB"] = os.path.join(workdir, "estado.sqlite")
+    os.environ["CYBERPUERTA_RUN_ID"] = f"bench-{args.perfil}-{args.semilla}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import scraper_cyberpuerta as sc
+
+    site = MockSite(args.perfil, args.escala, args.semilla)
+    base = site.start()
+    sc.configure(
+        base_url=base,
+        codes=[f"MOCK-{i:05d}" for i in range(args.items)],
+        urls=[],
+        category_urls=[],
+        workers=args.workers,
+        max_hours=args.max_horas,
+    )
+    clock = ScaledTime(args.escala)
+    sc.time = clock
+    sc.metrics = sc.RunMetrics()
+    sc.METRICS_DIR = workdir
+
+    print(f"🧪 Perfil '{args.perfil}' en {base}, escala {args.escala:g}, {args.items} ítems, "
+          f"{args.workers} worker(s). Salidas en {workdir}\n")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    t0 = time.monotonic()
+    try:
+        _, outputs, _ = sc.main(1)
+        with open(outputs["csv"], encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.DictReader(f))
+    finally:
+        os.chdir(cwd)
+        site.stop()
+    real_seconds = time.monotonic() - t0
+
+    rep = sc.metrics.report()
+    t = rep["tiempo_items"]
+    hours = rep["segundos"] / 3600.0
+    ok = sum(1 for r in rows if r["STATUS"] == "OK")
+    # Sin resultados y 404 son respuestas válidas del sitio, no fallas del scraper
+    answered = sum(1 for r in rows if not r["STATUS"].startswith(("HTTP error", "Error:")))
+
+    def share(stage):
+        return t[stage] / t["total"] if t["total"] else 0.0
+
+    print("\n" + "=" * 60)
+    print(f"Duración: {hours:.2f} h del sitio ({real_seconds:.1f} s reales)")
+    print(f"Ítems/hora: {len(rows) / hours if hours else 0.0:.1f}")
+    print(f"Éxito: {answered}/{args.items} respondidos ({answered / args.items:.1%}), {ok} con precio")
+    print(f"Tiempo de ítems: espera {share('espera'):.1%}, backoff {share('backoff'):.1%}, "
+          f"red {share('red'):.1%}, parseo {share('parseo'):.1%}")
+    print(f"Reintentos: {rep['reintentos'] or 'ninguno'} "
+          f"(presupuesto: {rep['presupuesto_reintentos']['negados']} negados)")
+    print(f"Circuito: {rep['circuito']['aperturas']} aperturas, "
+          f"{rep['circuito']['segundos_abierto'] / 60:.1f} min en pausa")
+    print(f"Respuestas del sitio simulado: {dict(sorted(site.stats.items()))}")
+    print(f"Tasa AIMD final: {rep['aimd']['tasa']:.2f} pet/min")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
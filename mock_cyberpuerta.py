@@ -0,0 +1,215 @@
+"""
+Sitio de Cyberpuerta simulado, para pruebas de punta a punta sin tocar el
+sitio real.
+
+    python mock_cyberpuerta.py --perfil sitio --puerto 8765
+    CYBERPUERTA_BASE_URL=http://127.0.0.1:8765 python scraper_cyberpuerta.py
+
+Sirve búsquedas, detalles y listados armados con las páginas de fixtures/
+(los enlaces se reescriben para que apunten al servidor local) e inyecta
+latencia, bloqueos 429/403 con Retry-After, errores 5xx y 404 según un
+perfil; además cierra las conexiones que pasan su keep-alive sin uso. El
+límite de tasa es un token bucket del lado del servidor: quien lo rebasa
+recibe 429 (o 403) durante toda la ventana de bloqueo, como hace el sitio
+real.
+
+Cada SKU tiene siempre el mismo destino (con resultados, sin resultados o
+detalle 404) para una semilla dada, así dos corridas son comparables.
+"""
+import argparse
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SITE_URL = "https://www.cyberpuerta.mx"
+# Primer producto de fixtures/busqueda_resultados.html: se sustituye por el del SKU
+FIRST_PRODUCT_PATH = "/Computo-Hardware/Discos-Duros-SSD-NAS/SSD/SSD-Kingston-NV3-1TB-PCI-Express-4-0-M-2.html"
+
+# Tiempos en segundos "del sitio"; con escala < 1 todo corre más rápido.
+PROFILES = {
+    "limpio": {
+        "latencia": (0.05, 0.2), "keepalive": 75, "limite_por_min": 0.0, "rafaga": 1, "retry_after": 0,
+        "p_403": 0.0, "p_5xx": 0.0, "p_404": 0.0, "p_sin_resultados": 0.0,
+    },
+    "sitio": {
+        "latencia": (0.3, 1.5), "keepalive": 5, "limite_por_min": 3.0, "rafaga": 3, "retry_after": 60,
+        "p_403": 0.2, "p_5xx": 0.01, "p_404": 0.02, "p_sin_resultados": 0.05,
+    },
+    "hostil": {
+        "latencia": (0.5, 4.0), "keepalive": 5, "limite_por_min": 1.5, "rafaga": 2, "retry_after": 120,
+        "p_403": 0.5, "p_5xx": 0.05, "p_404": 0.05, "p_sin_resultados": 0.1,
+    },
+}
+
+
+def load_pages():
+    pages = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith(".html"):
+            with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+                pages[name[:-5]] = f.read()
+    return pages
+
+
+class MockSite:
+    """
+    Servidor en un hilo aparte. `start()` devuelve la URL base para
+    CYBERPUERTA_BASE_URL; `stats` cuenta respuestas por status.
+    """
+
+    def __init__(self, perfil="sitio", escala=1.0, semilla=0, **ajustes):
+        self.cfg = dict(PROFILES[perfil], **ajustes)
+        self.escala = escala
+        self.semilla = semilla
+        self.rng = random.Random(semilla)
+        self.lock = threading.Lock()
+        self.pages = load_pages()
+        self.details = [p for p in self.pages if p.startswith("detalle_")]
+        self.tokens = float(self.cfg["rafaga"])
+        self.last = self.now()
+        self.blocked_until = 0.0
+        self.block_status = 429
+        self.stats = {}
+        self.server = None
+        self.base_url = None
+
+    def now(self):
+        return time.monotonic() / self.escala
+
+    def _fate(self, key, field):
+        # Destino fijo por SKU y semilla, independiente del orden de llegada
+        h = zlib.crc32(f"{self.semilla}:{field}:{key}".encode()) / 0xFFFFFFFF
+        return h < self.cfg[field]
+
+    def _admit(self):
+        """None si la petición pasa; si no, (status, Retry-After)."""
+        with self.lock:
+            now = self.now()
+            if now < self.blocked_until:
+                return self.block_status, int(self.blocked_until - now) + 1
+            limit = self.cfg["limite_por_min"]
+            if limit <= 0:
+                return None
+            self.tokens = min(float(self.cfg["rafaga"]), self.tokens + (now - self.last) * limit / 60.0)
+            self.last = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return None
+            self.blocked_until = now + self.cfg["retry_after"]
+            self.block_status = 403 if self.rng.random() < self.cfg["p_403"] else 429
+            return self.block_status, int(self.cfg["retry_after"])
+
+    def _rewrite(self, html):
+        return html.replace(SITE_URL, self.base_url)
+
+    def route(self, path):
+        """(status, html) para una ruta; sin fallas inyectadas."""
+        u = urlparse(path)
+        if u.path == "/index.php":
+            sku = parse_qs(u.query).get("searchparam", [""])[0].strip()
+            if not sku or self._fate(sku, "p_sin_resultados"):
+                return 200, self._rewrite(self.pages["busqueda_sin_resultados"])
+            html = self.pages["busqueda_resultados"].replace(
+                SITE_URL + FIRST_PRODUCT_PATH, f"{SITE_URL}/producto/{quote(sku, safe='')}.html"
+            )
+            return 200, self._rewrite(html)
+        m = re.fullmatch(r"/producto/(.+)\.html", u.path)
+        if m:
+            sku = unquote(m.group(1))
+            if self._fate(sku, "p_404"):
+                return 404, "<html><body>Página no encontrada</body></html>"
+            name = self.details[zlib.crc32(sku.encode()) % len(self.details)]
+            return 200, self._rewrite(self.pages[name])
+        if u.path.endswith("/2/"):
+            return 200, self._rewrite(self.pages["listado_pagina2"])
+        if u.path.endswith("/") and u.path != "/":
+            return 200, self._rewrite(self.pages["listado_pagina1"])
+        return 404, "<html><body>Página no encontrada</body></html>"
+
+    def handle(self, path):
+        """(status, headers, cuerpo) con latencia y fallas del perfil."""
+        lo, hi = self.cfg["latencia"]
+        with self.lock:
+            latency = self.rng.uniform(lo, hi)
+            fail_5xx = self.rng.random() < self.cfg["p_5xx"]
+        time.sleep(latency * self.escala)
+        blocked = self._admit()
+        if blocked is not None:
+            status, retry_after = blocked
+            return status, {"Retry-After": str(retry_after)}, b"<html><body>Demasiadas peticiones</body></html>"
+        if fail_5xx:
+            return 503, {}, b"<html><body>Servicio no disponible</body></html>"
+        status, html = self.route(path)
+        return status, {"Content-Type": "text/html; charset=utf-8"}, html.encode("utf-8")
+
+    def _count(self, status):
+        with self.lock:
+            self.stats[status] = self.stats.get(status, 0) + 1
+
+    def start(self, host="127.0.0.1", port=0):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # El servidor cierra las conexiones inactivas, como el sitio real
+            timeout = self.cfg["keepalive"] * self.escala
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                status, headers, body = site.handle(self.path)
+                site._count(status)
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Keep-Alive", f"timeout={site.cfg['keepalive']}")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://{host}:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--perfil", choices=sorted(PROFILES), default="sitio")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--puerto", type=int, default=8765)
+    ap.add_argument("--escala", type=float, default=1.0, help="factor de tiempo (0.01 = 100 veces más rápido)")
+    ap.add_argument("--semilla", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    site = MockSite(args.perfil, args.escala, args.semilla)
+    base = site.start(args.host, args.puerto)
+    print(f"🧪 Sitio simulado ({args.perfil}) en {base}")
+    print(f"   CYBERPUERTA_BASE_URL={base} python scraper_cyberpuerta.py")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        site.stop()
+        print(f"Respuestas por status: {dict(sorted(site.stats.items()))}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,20 +1,30 @@
 import os
 import re
+import csv
 import time
 import random
 import sys
+import socket
 import statistics
-from datetime import datetime
-from urllib.parse import urljoin, quote_plus
-
-import requests
-import pandas as pd
-from bs4 import BeautifulSoup
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-import smtplib
-import ssl
-from email.message import EmailMessage
+import sqlite3
+import threading
+import json
+import zlib
+import glob
+import hashlib
+import argparse
+import math
+import heapq
+import signal
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, quote_plus, urlparse
+
+# requests, lxml, bs4, xlsxwriter y smtplib se importan donde se usan: así
+# merge/report/email arrancan sin cargarlos y el módulo se puede importar
+# como biblioteca sin costo.
 
 # ================= PARÁMETROS (ajústalos si quieres) =================
 # Aquí pegas tus SKUs, uno por línea
@@ -234,64 +244,974 @@ INPUT_URLS = [
     # "https://www.cyberpuerta.mx/index.php?cl=search&searchparam=AUSDH16GUICL10-RA1",
 ]
 
-BASE_SEARCH = "https://www.cyberpuerta.mx/index.php?cl=search&searchparam="
+# Listados (categorías / filtros por marca) que se recorren completos antes
+# de buscar SKU por SKU. Cada página del listado resuelve precio y stock de
+# todos los productos que muestra; sólo los SKUs que no aparezcan en ningún
+# listado pasan a la búsqueda individual.
+INPUT_CATEGORY_URLS = [
+    # "https://www.cyberpuerta.mx/Computo-Hardware/Discos-Duros-SSD-NAS/SSD/Filtro/Marca/Kingston/",
+]
+INPUT_CATEGORY_URLS += [
+    u for u in os.environ.get("CYBERPUERTA_CATEGORIAS", "").split(",") if u.strip()
+]
+CATEGORY_MAX_PAGES = int(os.environ.get("CYBERPUERTA_CATEGORIA_MAX_PAGINAS", "20"))
+
+# Raíz del sitio. Con CYBERPUERTA_BASE_URL se apunta a otro servidor, p. ej.
+# el sitio simulado de mock_cyberpuerta.py para pruebas de punta a punta.
+BASE_URL = os.environ.get("CYBERPUERTA_BASE_URL", "https://www.cyberpuerta.mx").rstrip("/")
+BASE_SEARCH = f"{BASE_URL}/index.php?cl=search&searchparam="
 
 # --- Control de tiempos (por SKU, como en tu script de Colab) ---
 INITIAL_WAIT_RANGE = (50.0, 80.0)
 BETWEEN_REQUESTS    = (4.0, 7.0)
-MAX_RETRIES         = 7
 BACKOFF_BASE        = 4.0
 BACKOFF_CAP         = 90.0
 
-ROLLING_WINDOW      = 6
-ALPHA_SENSITIVITY   = 1.2
+# --- Reintentos: una sola política para toda la corrida ---
+# Cada petición tiene RETRY_MAX_ATTEMPTS intentos y la corrida completa un
+# presupuesto de reintentos: RETRY_BUDGET_MIN de arranque más
+# RETRY_BUDGET_RATIO por cada petición nueva. Con el presupuesto agotado
+# una falla ya no se reintenta (el journal la retoma en otra corrida).
+RETRY_MAX_ATTEMPTS  = int(os.environ.get("CYBERPUERTA_REINTENTOS", "7"))
+RETRY_BUDGET_RATIO  = float(os.environ.get("CYBERPUERTA_PRESUPUESTO_REINTENTOS", "0.2"))
+RETRY_BUDGET_MIN    = 10
+
+# --- Circuit breaker de todo el sitio ---
+# Un 429/403, o BREAKER_FAILURES fallas seguidas (5xx / red), abren el
+# circuito: nadie pide nada hasta que pase el Retry-After o la pausa
+# (BREAKER_BASE, doblándose en cada apertura seguida hasta BREAKER_CAP).
+# Después una sola petición de prueba decide si se cierra o se reabre.
+BREAKER_FAILURES    = 5
+BREAKER_BASE        = 60.0
+BREAKER_CAP         = 1800.0
+
+# --- Control adaptativo AIMD de la tasa de peticiones ---
+# La tasa (pet/min) sube un poco con cada respuesta sana y se parte a la
+# mitad con cada 429/403; las respuestas lentas la bajan suavemente. Se
+# guarda en el estado para que la siguiente corrida arranque cerca de la
+# última tasa segura en vez de volver a aprender desde cero. El techo es
+# RATE_PER_MIN salvo que se suba a propósito con CYBERPUERTA_AIMD_MAX_RATE:
+# por defecto AIMD sólo frena, nunca carga al sitio más que el ritmo base.
+AIMD_MIN_RATE       = float(os.environ.get("CYBERPUERTA_AIMD_MIN_RATE", "0.3"))
+AIMD_MAX_RATE       = float(os.environ.get("CYBERPUERTA_AIMD_MAX_RATE", "0"))   # 0 = RATE_PER_MIN
+AIMD_INCREASE       = 0.05   # pet/min que se suman por respuesta OK
+AIMD_DECREASE       = 0.5    # factor ante 429/403
+AIMD_SLOW_FACTOR    = 0.9    # factor ante respuesta lenta
+AIMD_SLOW_SECONDS   = 8.0    # latencia a partir de la cual se considera lenta
+AIMD_COOLDOWN       = 30.0   # s mínimos entre dos recortes (una ráfaga = un recorte)
 
 UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
     "Chrome/126.0.0.0 Safari/537.36"
 )
 
+# ========= MODO CONCURRENTE (opcional) ==============================
+# Con WORKERS > 1 los ítems se procesan en paralelo y las esperas fijas por
+# SKU se sustituyen por un token bucket global: todos los workers comparten
+# el mismo techo de peticiones por minuto al sitio.
+WORKERS = int(os.environ.get("CYBERPUERTA_WORKERS", "1"))
+# 1.7 pet/min ~ ritmo del modo serial (2 peticiones cada ~70 s por SKU).
+# Es la tasa de arranque del control AIMD cuando no hay estado guardado y la
+# tasa para la que están calibrados INITIAL_WAIT_RANGE / BETWEEN_REQUESTS.
+RATE_PER_MIN = float(os.environ.get("CYBERPUERTA_RATE_PER_MIN", "1.7"))
+RATE_BURST = float(os.environ.get("CYBERPUERTA_RATE_BURST", "1"))
+
 # ========= CONFIG GLOBAL DE TIEMPO / LOOPS PARA GITHUB ==============
 MAX_TOTAL_HOURS = float(os.environ.get("CYBERPUERTA_MAX_HOURS", "5.667"))
 TIME_GUARD_MINUTES = float(os.environ.get("CYBERPUERTA_GUARD_MINUTES", "10"))
 
 # 🔴 AQUÍ ESTABA EL BUG: antes leías CYBERPUERTA_LOOP_INDEX, pero en el YAML mandas LOOP_INDEX
 # Soportamos ambos nombres por si acaso.
+# Ya no hay tope de 3: el avance real vive en el journal de la corrida y
+# cualquier arranque posterior continúa donde se quedó el anterior.
 LOOP_INDEX = int(os.environ.get("LOOP_INDEX", os.environ.get("CYBERPUERTA_LOOP_INDEX", "1")))
 if LOOP_INDEX < 1:
     LOOP_INDEX = 1
-if LOOP_INDEX > 3:
-    LOOP_INDEX = 3
+
+# Identificador de la corrida para el journal por SKU. En GitHub Actions
+# GITHUB_RUN_ID es el mismo en los 3 loops y en los "re-run" del workflow.
+RUN_ID = (
+    os.environ.get("CYBERPUERTA_RUN_ID")
+    or os.environ.get("GITHUB_RUN_ID")
+    or datetime.now().strftime("%Y-%m-%d")
+)
+# Adjuntar también el CSV/xlsx completos al correo (por defecto sólo cambios)
+EMAIL_FULL_FILES = os.environ.get("CYBERPUERTA_EMAIL_COMPLETO", "0") == "1"
+
+# Orden de los ítems por valor esperado (volatilidad, antigüedad, fallos)
+# según el historial. CYBERPUERTA_PRIORIDAD=0 conserva el orden de INPUT_CODES.
+PRIORITY_ENABLED = os.environ.get("CYBERPUERTA_PRIORIDAD", "1") == "1"
+PRIORITY_WINDOW_DAYS = 60     # historial que se considera
+PRIORITY_MAX_OBS = 30         # observaciones más recientes por SKU
+PRIORITY_WEIGHTS = {"cambio": 1.0, "antiguedad": 0.5, "fallos": 0.3}
+
+# Shard (i, N) de esta corrida; None = todos los SKUs. Ver set_shard().
+SHARD = None
+
+# Intentos por ítem que terminan en excepción antes de darlo por fallido
+JOURNAL_MAX_ATTEMPTS = int(os.environ.get("CYBERPUERTA_MAX_INTENTOS", "3"))
+
+# Carpeta del textfile de Prometheus (p. ej. la del textfile collector de node_exporter)
+METRICS_DIR = os.environ.get("CYBERPUERTA_METRICAS_DIR", ".")
 
 # ================== Sesión HTTP con retries básicos (5xx) ==================
-session = requests.Session()
-session.headers.update({
+# Se arma al primer uso (get_session): importar requests/urllib3 cuesta más
+# que todo lo demás del módulo.
+class _TimedConnectionMixin:
+    # Resuelve el nombre aparte para medir DNS y conexión (TCP + TLS) por separado
+    _dns_seconds = 0.0
+
+    def _new_conn(self):
+        host = self._dns_host
+        t0 = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+        except OSError:
+            infos = None
+        self._dns_seconds = time.monotonic() - t0
+        conn_timing_add("dns", self._dns_seconds)
+        if not infos:
+            return super()._new_conn()
+        self._dns_host = infos[0][4][0]
+        try:
+            return super()._new_conn()
+        except OSError:
+            if len(infos) == 1:
+                raise
+            # Que urllib3 recorra todas las direcciones como de costumbre
+            self._dns_host = host
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+    def connect(self):
+        t0 = time.monotonic()
+        self._dns_seconds = 0.0
+        try:
+            super().connect()
+        finally:
+            conn_timing_add("conexion", max(0.0, time.monotonic() - t0 - self._dns_seconds))
+
+
+# Cliente HTTP: "requests" (HTTP/1.1, con precalentado de conexiones) o
+# "httpx" (HTTP/2; requiere el extra opcional httpx[http2]).
+HTTP_CLIENT = os.environ.get("CYBERPUERTA_CLIENTE_HTTP", "requests")
+
+DEFAULT_HEADERS = {
     "User-Agent": UA,
     "Accept-Language": "es-MX,es;q=0.9,en;q=0.8",
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    "Referer": "https://www.cyberpuerta.mx/",
     "Cache-Control": "no-cache",
-})
-retry = Retry(
-    total=MAX_RETRIES,
-    connect=MAX_RETRIES,
-    read=MAX_RETRIES,
-    backoff_factor=0.5,
-    status_forcelist=[500, 502, 503, 504],
-    allowed_methods=["GET", "HEAD"],
-    raise_on_status=False,
-)
-session.mount("http://", HTTPAdapter(max_retries=retry))
-session.mount("https://", HTTPAdapter(max_retries=retry))
+}
+
+
+class _RawBytes:
+    # Lo poco de response.raw que usa _record_fetch
+    retries = None
+
+    def __init__(self, n):
+        self.n = n
+
+    def tell(self):
+        return self.n
+
+
+class HttpxSession:
+    """
+    Cliente HTTP/2 con la interfaz de requests.Session que usa
+    get_with_backoff: `headers` y `get()` devolviendo un requests.Response.
+    La conexión (TCP + TLS) se mide con los eventos de trace de httpcore; el
+    DNS queda incluido en ella.
+    """
+
+    def __init__(self, headers):
+        import httpx
+        self.httpx = httpx
+        self.client = httpx.Client(http2=True, headers=headers)
+        self.headers = self.client.headers
+
+    @staticmethod
+    def _trace(event, info):
+        if event in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            _timing.trace_t0 = time.monotonic()
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            conn_timing_add("conexion", time.monotonic() - getattr(_timing, "trace_t0", time.monotonic()))
+
+    def get(self, url, allow_redirects=True, timeout=30, headers=None, stream=False):
+        import requests
+        try:
+            resp = self.client.get(url, headers=headers, timeout=timeout, follow_redirects=allow_redirects,
+                                   extensions={"trace": self._trace})
+        except self.httpx.HTTPError as e:
+            raise requests.ConnectionError(str(e)) from e
+        r = requests.Response()
+        r.status_code = resp.status_code
+        r.reason = resp.reason_phrase
+        r.headers = requests.structures.CaseInsensitiveDict(dict(resp.headers))
+        r._content = resp.content
+        r.encoding = resp.encoding
+        r.url = str(resp.url)
+        r.raw = _RawBytes(resp.num_bytes_downloaded)
+        return r
+
+
+def _build_session():
+    if HTTP_CLIENT == "httpx":
+        try:
+            session = HttpxSession(dict(DEFAULT_HEADERS, Referer=f"{BASE_URL}/"))
+            print("🔌 Cliente HTTP: httpx con HTTP/2.")
+            return session
+        except ImportError:
+            print("⚠️ CYBERPUERTA_CLIENTE_HTTP=httpx pero falta httpx[http2]; se usa requests.")
+
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = type("TimedHTTPConnection", (_TimedConnectionMixin, HTTPConnection), {})
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = type("TimedHTTPSConnection", (_TimedConnectionMixin, HTTPSConnection), {})
+
+    class TimedAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": TimedHTTPConnectionPool,
+                "https": TimedHTTPSConnectionPool,
+            }
+
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    session.headers["Referer"] = f"{BASE_URL}/"
+    # Sin reintentos de urllib3: todos pasan por get_with_backoff
+    session.mount("http://", TimedAdapter())
+    session.mount("https://", TimedAdapter())
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _build_session()
+        return _session
+
+
+# ================== Conexiones entre esperas largas =====================
+# Entre ítems se duerme 50–80 s, mucho más que el keep-alive de casi
+# cualquier servidor: el socket que queda en el pool ya está muerto y
+# reusarlo cuesta un intento fallido más un handshake nuevo. Si el host
+# lleva más de su keep-alive sin uso, sus sockets se descartan antes de la
+# petición y, con el cliente requests, PREWARM_LEAD s antes de que termine
+# la espera se abre uno nuevo (TCP + TLS, sin mandar nada al sitio): el
+# handshake queda dentro de la espera y no en la petición.
+PREWARM_ENABLED = os.environ.get("CYBERPUERTA_PRECALENTAR", "1") == "1"
+PREWARM_LEAD = 3.0
+KEEPALIVE_IDLE = float(os.environ.get("CYBERPUERTA_KEEPALIVE_SEG", "15"))
+_KEEPALIVE_RE = re.compile(r"timeout\s*=\s*(\d+)", re.I)
+_host_last_used = {}    # host -> (último uso, keep-alive en segundos)
+
+
+def note_connection_use(url, headers=None):
+    keepalive = KEEPALIVE_IDLE
+    m = _KEEPALIVE_RE.search((headers or {}).get("Keep-Alive", ""))
+    if m:
+        # Un segundo de margen contra el cierre del lado del servidor
+        keepalive = min(keepalive, max(0.0, float(m.group(1)) - 1.0))
+    _host_last_used[urlparse(url).netloc] = (time.monotonic(), keepalive)
+
+
+def connection_is_stale(url):
+    last = _host_last_used.get(urlparse(url).netloc)
+    return last is not None and time.monotonic() - last[0] >= last[1]
+
+
+def _pool_for(session, url):
+    # Mismos verify/cert/proxies que session.get() (incluye REQUESTS_CA_BUNDLE):
+    # si no, la conexión quedaría en un pool distinto al de la petición
+    import requests
+    settings = session.merge_environment_settings(url, {}, None, None, None)
+    request = requests.Request("GET", url).prepare()
+    return session.get_adapter(url).get_connection_with_tls_context(
+        request, settings["verify"], proxies=settings["proxies"], cert=settings["cert"]
+    )
+
+
+def drop_stale_connections(url):
+    """Cierra los sockets inactivos del host si ya pasó su keep-alive."""
+    session = get_session()
+    if not connection_is_stale(url) or not hasattr(session, "get_adapter"):
+        return False
+    # clear() cierra los pools; el siguiente acceso arma uno nuevo
+    session.get_adapter(url).poolmanager.clear()
+    _host_last_used.pop(urlparse(url).netloc, None)
+    return True
+
+
+def prewarm_connection(url):
+    """Deja en el pool una conexión recién abierta al host de `url`."""
+    session = get_session()
+    netloc = urlparse(url).netloc
+    if not PREWARM_ENABLED or not hasattr(session, "get_adapter"):
+        return False
+    if netloc in _host_last_used and not connection_is_stale(url):
+        return False
+    drop_stale_connections(url)
+    t0 = time.monotonic()
+    try:
+        pool = _pool_for(session, url)
+        conn = pool._get_conn()
+        conn.connect()
+        pool._put_conn(conn)
+    except Exception as e:
+        # Sólo era una optimización: la petición abrirá su propia conexión
+        print(f"   🔌 No se pudo precalentar la conexión a {netloc}: {e}")
+        return False
+    metrics.record_connection("precalentadas", time.monotonic() - t0)
+    note_connection_use(url)
+    return True
+
+
+def sleep_until_fetch(seconds, url=None):
+    """time.sleep(seconds), precalentando la conexión al final de la espera."""
+    lead = PREWARM_LEAD if PREWARM_ENABLED else 0.0
+    if seconds <= lead or lead <= 0:
+        time.sleep(seconds)
+        return
+    time.sleep(seconds - lead)
+    t0 = time.monotonic()
+    prewarm_connection(url or BASE_URL)
+    time.sleep(max(0.0, lead - (time.monotonic() - t0)))
+
+# ================== Estado persistente (SQLite) ==================
+# Un solo archivo para todo lo que queremos recordar entre corridas.
+# En GitHub Actions se conserva entre días con actions/cache.
+STATE_DB = os.environ.get("CYBERPUERTA_STATE_DB", "cyberpuerta_estado.sqlite")
+
+# Días que confiamos en la URL de producto ya resuelta para un SKU (0 = sin caché)
+URL_CACHE_DAYS = float(os.environ.get("CYBERPUERTA_URL_CACHE_DAYS", "14"))
+
+# Caché HTTP de páginas de detalle con GET condicional (ETag / Last-Modified).
+# Opcional: CYBERPUERTA_HTTP_CACHE=1 para activarlo.
+HTTP_CACHE = os.environ.get("CYBERPUERTA_HTTP_CACHE", "0") == "1"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS estado (
+    clave       TEXT PRIMARY KEY,
+    valor       TEXT NOT NULL,
+    actualizado REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    corrida     TEXT NOT NULL,
+    pos         INTEGER NOT NULL,
+    tipo        TEXT NOT NULL,
+    valor       TEXT NOT NULL,
+    estado      TEXT NOT NULL,
+    intentos    INTEGER NOT NULL DEFAULT 0,
+    fila        TEXT,
+    actualizado REAL NOT NULL,
+    PRIMARY KEY (corrida, tipo, valor)
+);
+CREATE INDEX IF NOT EXISTS jobs_estado ON jobs (corrida, estado, pos);
+CREATE TABLE IF NOT EXISTS historial (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    sku         TEXT NOT NULL,
+    ts          REAL NOT NULL,
+    fecha       TEXT NOT NULL,
+    corrida     TEXT NOT NULL,
+    url         TEXT,
+    titulo      TEXT,
+    precio_num  REAL,
+    stock_num   INTEGER,
+    stock_texto TEXT,
+    status      TEXT,
+    precio_texto TEXT
+);
+CREATE INDEX IF NOT EXISTS historial_sku_ts ON historial (sku, ts);
+CREATE INDEX IF NOT EXISTS historial_corrida ON historial (corrida);
+CREATE TABLE IF NOT EXISTS duraciones (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts          REAL NOT NULL,
+    corrida     TEXT NOT NULL,
+    sku         TEXT NOT NULL,
+    espera      REAL NOT NULL,
+    red         REAL NOT NULL,
+    backoff     REAL NOT NULL,
+    parseo      REAL NOT NULL,
+    total       REAL NOT NULL,
+    status      TEXT
+);
+CREATE TABLE IF NOT EXISTS url_cache (
+    sku         TEXT PRIMARY KEY,
+    url         TEXT NOT NULL,
+    titulo      TEXT NOT NULL DEFAULT '',
+    actualizado REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archivo (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    sku           TEXT NOT NULL,
+    ts            REAL NOT NULL,
+    fecha         TEXT NOT NULL,
+    corrida       TEXT NOT NULL,
+    tipo          TEXT NOT NULL,
+    url           TEXT NOT NULL,
+    status        INTEGER NOT NULL,
+    codificacion  TEXT,
+    sha256        TEXT NOT NULL,
+    bytes         INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archivo_sku_fecha ON archivo (sku, fecha);
+CREATE INDEX IF NOT EXISTS archivo_tipo_fecha ON archivo (tipo, fecha);
+CREATE TABLE IF NOT EXISTS agenda (
+    tipo        TEXT NOT NULL,
+    valor       TEXT NOT NULL,
+    proxima     REAL NOT NULL,
+    intervalo   REAL NOT NULL,
+    fallos      INTEGER NOT NULL DEFAULT 0,
+    ultima      REAL,
+    PRIMARY KEY (tipo, valor)
+);
+CREATE TABLE IF NOT EXISTS http_cache (
+    url           TEXT PRIMARY KEY,
+    etag          TEXT,
+    last_modified TEXT,
+    cuerpo        BLOB,
+    campos        TEXT,
+    actualizado   REAL NOT NULL
+);
+"""
+
+_db_conn = None
+_db_lock = threading.RLock()
+
+
+# Columnas agregadas después de crear la tabla: las bases viejas las reciben aquí
+_ADDED_COLUMNS = (("historial", "precio_texto", "TEXT"),)
+
+
+def _migrate_db(conn):
+    for table, column, decl in _ADDED_COLUMNS:
+        if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+            with conn:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def get_db():
+    global _db_conn
+    with _db_lock:
+        if _db_conn is None:
+            conn = sqlite3.connect(STATE_DB, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            _migrate_db(conn)
+            _db_conn = conn
+        return _db_conn
+
+
+# ================= Tiempos por etapa de cada ítem =====================
+# Acumulador por hilo: cada ítem suma aquí cuánto pasó esperando a propósito,
+# en la red, en backoff y parseando. run_item() lo guarda en `duraciones`.
+STAGES = ("espera", "red", "backoff", "parseo")
+_timing = threading.local()
+
+
+def timing_reset():
+    _timing.stages = dict.fromkeys(STAGES, 0.0)
+
+
+def timing_add(stage_name, seconds):
+    stages = getattr(_timing, "stages", None)
+    if stages is not None:
+        stages[stage_name] += seconds
+
+
+def timing_snapshot():
+    return dict(getattr(_timing, "stages", None) or dict.fromkeys(STAGES, 0.0))
+
+
+@contextmanager
+def stage(stage_name, tier=None):
+    # tier: nivel del parser, para separar el tiempo de parseo en el reporte
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        dt = time.monotonic() - t0
+        timing_add(stage_name, dt)
+        if tier is not None:
+            metrics.record_parse(tier, dt)
+
+
+def conn_timing_add(phase, seconds):
+    conn = getattr(_timing, "conn", None)
+    if conn is not None:
+        conn[phase] += seconds
+
+
+# ================= Métricas de la corrida ===============================
+# Todo lo que se mide de cada petición y de cada ítem, acumulado para el
+# reporte JSON (cyberpuerta_reporte_loop{n}.json) y el textfile de
+# Prometheus (cyberpuerta_metricas.prom, para el textfile collector).
+FETCH_PHASES = ("dns", "conexion", "ttfb", "descarga")
+
+
+def _quantiles(values):
+    values = sorted(values)
+    return {q: _percentile(values, float(q)) for q in ("0.5", "0.9", "0.99")}
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {p: [] for p in FETCH_PHASES}
+        self.requests = {}      # (tipo, status) -> peticiones
+        self.bytes = {}         # tipo -> [bytes en el cable, bytes decodificados]
+        self.retries = {}       # status o error de red -> reintentos
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.items = 0
+        self.item_seconds = 0.0
+        self.parse = {}         # nivel -> [páginas, segundos]
+        self.connections = {"nuevas": 0, "reusadas": 0, "precalentadas": 0}
+        self.prewarm_seconds = 0.0
+
+    def record_fetch(self, kind, status, phases, wire_bytes, body_bytes):
+        with self.lock:
+            for phase, secs in phases.items():
+                self.phases[phase].append(secs)
+            key = (kind, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            b = self.bytes.setdefault(kind, [0, 0])
+            b[0] += wire_bytes
+            b[1] += body_bytes
+
+    def record_retry(self, reason):
+        with self.lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def record_item(self, stages, total):
+        with self.lock:
+            for k, v in stages.items():
+                self.stages[k] += v
+            self.items += 1
+            self.item_seconds += total
+
+    def record_connection(self, kind, seconds=0.0):
+        with self.lock:
+            self.connections[kind] += 1
+            if kind == "precalentadas":
+                self.prewarm_seconds += seconds
+
+    def record_parse(self, tier, seconds):
+        with self.lock:
+            p = self.parse.setdefault(tier, [0, 0.0])
+            p[0] += 1
+            p[1] += seconds
+
+    def report(self):
+        with self.lock:
+            espera, backoff = self.stages["espera"], self.stages["backoff"]
+            controller = get_rate_controller()
+            return {
+                "corrida": RUN_ID,
+                "inicio": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                "segundos": time.time() - self.started,
+                "workers": WORKERS,
+                "items": self.items,
+                "tiempo_items": {
+                    "total": self.item_seconds,
+                    **self.stages,
+                    "trabajo": max(0.0, self.item_seconds - espera - backoff),
+                },
+                "fases_peticion": {
+                    p: {"n": len(v), "suma": sum(v), **_quantiles(v)} for p, v in self.phases.items()
+                },
+                "peticiones": [
+                    {"tipo": k, "status": st, "n": n} for (k, st), n in sorted(self.requests.items())
+                ],
+                "bytes": {k: {"cable": b[0], "decodificados": b[1]} for k, b in sorted(self.bytes.items())},
+                "reintentos": dict(sorted(self.retries.items())),
+                "parseo": {t: {"paginas": n, "segundos": secs} for t, (n, secs) in sorted(self.parse.items())},
+                "aimd": {"tasa": controller.rate, **controller.counts},
+                "presupuesto_reintentos": {**retry_policy.counts, "disponible": retry_policy.budget},
+                "circuito": {"estado": breaker.state, **breaker.counts},
+                "cache_http": dict(http_cache_stats),
+                "reuso_detalle": dict(product_pages.counts),
+                "cosecha_busqueda": dict(search_harvest.counts),
+                "reintentos_diferidos": dict(deferred_retries.counts),
+                "frescura": dict(freshness_stats),
+                "conexiones": {**self.connections, "segundos_precalentado": self.prewarm_seconds},
+            }
+
+    def prometheus(self):
+        rep = self.report()
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lbl = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                out.append(f"{name}{{{lbl}}} {value:.6g}" if lbl else f"{name} {value:.6g}")
+
+        metric("cyberpuerta_run_seconds", "gauge", "Duración de la corrida.", [({}, rep["segundos"])])
+        metric("cyberpuerta_items_total", "counter", "Ítems procesados.", [({}, rep["items"])])
+        metric("cyberpuerta_item_seconds_total", "counter",
+               "Tiempo de los ítems por etapa (espera intencional, backoff, red, parseo, trabajo).",
+               [({"etapa": k}, v) for k, v in rep["tiempo_items"].items() if k != "total"])
+        fases = rep["fases_peticion"]
+        metric("cyberpuerta_fetch_phase_seconds", "summary", "Fases de cada petición HTTP.",
+               [({"fase": p, "quantile": q}, f[q]) for p, f in fases.items() for q in ("0.5", "0.9", "0.99")])
+        out.extend(f'cyberpuerta_fetch_phase_seconds_sum{{fase="{p}"}} {f["suma"]:.6g}' for p, f in fases.items())
+        out.extend(f'cyberpuerta_fetch_phase_seconds_count{{fase="{p}"}} {f["n"]}' for p, f in fases.items())
+        metric("cyberpuerta_requests_total", "counter", "Respuestas HTTP por tipo de página y status.",
+               [({"tipo": r["tipo"], "status": r["status"]}, r["n"]) for r in rep["peticiones"]])
+        metric("cyberpuerta_response_bytes_total", "counter", "Bytes de respuesta por tipo de página.",
+               [({"tipo": k, "medida": m}, v) for k, b in rep["bytes"].items() for m, v in b.items()])
+        metric("cyberpuerta_retries_total", "counter", "Reintentos por status o error de red.",
+               [({"motivo": k}, v) for k, v in rep["reintentos"].items()])
+        metric("cyberpuerta_parse_seconds_total", "counter", "Tiempo de parseo por nivel del extractor.",
+               [({"nivel": t}, p["segundos"]) for t, p in rep["parseo"].items()])
+        metric("cyberpuerta_parse_pages_total", "counter", "Páginas parseadas por nivel del extractor.",
+               [({"nivel": t}, p["paginas"]) for t, p in rep["parseo"].items()])
+        metric("cyberpuerta_connections_total", "counter",
+               "Conexiones por petición: nuevas (con handshake), reusadas, y precalentadas durante la espera.",
+               [({"tipo": k}, v) for k, v in rep["conexiones"].items() if k != "segundos_precalentado"])
+        metric("cyberpuerta_prewarm_seconds_total", "counter", "Tiempo de handshake hecho durante las esperas.",
+               [({}, rep["conexiones"]["segundos_precalentado"])])
+        metric("cyberpuerta_retry_budget_denied_total", "counter",
+               "Reintentos negados por el presupuesto de la corrida.",
+               [({}, rep["presupuesto_reintentos"]["negados"])])
+        metric("cyberpuerta_circuit_open_total", "counter", "Aperturas del circuit breaker.",
+               [({}, rep["circuito"]["aperturas"])])
+        metric("cyberpuerta_circuit_open_seconds_total", "counter", "Pausa total impuesta por el circuit breaker.",
+               [({}, rep["circuito"]["segundos_abierto"])])
+        metric("cyberpuerta_requests_saved_total", "counter",
+               "Peticiones que no se hicieron por frescura o caché negativo.",
+               [({}, rep["frescura"]["peticiones_ahorradas"])])
+        metric("cyberpuerta_items_skipped_total", "counter", "Ítems no visitados, por motivo.",
+               [({"motivo": k}, rep["frescura"][k]) for k in ("frescos", "negativos")])
+        metric("cyberpuerta_aimd_rate", "gauge", "Tasa AIMD al final (peticiones/min).", [({}, rep["aimd"]["tasa"])])
+        metric("cyberpuerta_last_run_timestamp_seconds", "gauge", "Fin de la última corrida.", [({}, time.time())])
+        return "\n".join(out) + "\n"
+
+
+metrics = RunMetrics()
+
+
+def write_run_report(json_path, prom_path):
+    # Escritura atómica: el textfile collector nunca debe leer un archivo a medias
+    for path, text in ((json_path, json.dumps(metrics.report(), ensure_ascii=False, indent=2)),
+                       (prom_path, metrics.prometheus())):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
 
 
 def jitter(a, b):
     return random.uniform(a, b)
 
 
-def sleep_range(a, b):
-    t = jitter(a, b)
-    time.sleep(t)
+class TokenBucket:
+    """Limitador global: `acquire()` bloquea hasta que haya un token."""
+
+    def __init__(self, rate_per_min, burst=1.0, controller=None):
+        self.rate = max(rate_per_min, 1e-6) / 60.0
+        self.controller = controller
+        self.capacity = max(burst, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                if self.controller is not None:
+                    self.rate = max(self.controller.rate, 1e-6) / 60.0
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return waited
+                need = (1.0 - self.tokens) / self.rate
+            # Un poco de jitter para que los workers no salgan en bloque
+            t = need + jitter(0.0, min(2.0, need * 0.1))
+            sleep_until_fetch(t)
+            timing_add("espera", t)
+            waited += t
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def aimd_max_rate():
+    return AIMD_MAX_RATE if AIMD_MAX_RATE > 0 else RATE_PER_MIN
+
+
+class AimdController:
+    """
+    Tasa de peticiones al sitio (pet/min) con aumento aditivo y recorte
+    multiplicativo. `on_response()` se llama después de cada petición; las
+    pausas por Retry-After son del circuit breaker.
+    """
+
+    STATE_KEY = "aimd_rate"
+
+    def __init__(self, initial_rate):
+        self.rate = self._clamp(initial_rate)
+        self.saved_rate = None
+        self.last_cut = 0.0
+        self.counts = {"ok": 0, "bloqueos": 0, "lentas": 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _clamp(rate):
+        return min(aimd_max_rate(), max(AIMD_MIN_RATE, rate))
+
+    @classmethod
+    def load(cls):
+        with _db_lock:
+            row = get_db().execute(
+                "SELECT valor FROM estado WHERE clave = ?", (cls.STATE_KEY,)
+            ).fetchone()
+        rate = RATE_PER_MIN
+        if row:
+            try:
+                rate = float(row[0])
+            except ValueError:
+                pass
+        return cls(rate)
+
+    def save(self):
+        with _db_lock:
+            db = get_db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO estado (clave, valor, actualizado) VALUES (?, ?, ?)",
+                    (self.STATE_KEY, f"{self.rate:.4f}", time.time()),
+                )
+        self.saved_rate = self.rate
+
+    def _cut(self, factor, now):
+        if now - self.last_cut < AIMD_COOLDOWN:
+            return
+        self.rate = self._clamp(self.rate * factor)
+        self.last_cut = now
+
+    def on_response(self, status, latency):
+        now = time.monotonic()
+        with self.lock:
+            if status in (429, 403):
+                self.counts["bloqueos"] += 1
+                self._cut(AIMD_DECREASE, now)
+            elif latency > AIMD_SLOW_SECONDS:
+                self.counts["lentas"] += 1
+                self._cut(AIMD_SLOW_FACTOR, now)
+            elif status in (200, 304, 404):
+                self.counts["ok"] += 1
+                self.rate = self._clamp(self.rate + AIMD_INCREASE)
+            changed = self.rate != self.saved_rate
+        # Sólo se escribe cuando la tasa se mueve: en el techo no hay commit por respuesta
+        if changed:
+            self.save()
+
+    def slowdown(self):
+        """Factor por el que se estiran las esperas calibradas del modo serial."""
+        return RATE_PER_MIN / self.rate
+
+
+class RetryPolicy:
+    """
+    Intentos por petición, espera entre intentos y presupuesto de
+    reintentos de la corrida. `on_request()` se llama por cada petición
+    nueva y `try_spend()` antes de cada reintento.
+    """
+
+    def __init__(self, max_attempts=None, budget_ratio=None, budget_min=None):
+        self.max_attempts = max(1, RETRY_MAX_ATTEMPTS if max_attempts is None else max_attempts)
+        self.ratio = RETRY_BUDGET_RATIO if budget_ratio is None else budget_ratio
+        self.budget = float(RETRY_BUDGET_MIN if budget_min is None else budget_min)
+        self.counts = {"peticiones": 0, "reintentos": 0, "negados": 0}
+        self.lock = threading.Lock()
+
+    def on_request(self):
+        with self.lock:
+            self.counts["peticiones"] += 1
+            self.budget += self.ratio
+
+    def try_spend(self):
+        with self.lock:
+            if self.budget < 1.0:
+                self.counts["negados"] += 1
+                return False
+            self.budget -= 1.0
+            self.counts["reintentos"] += 1
+            return True
+
+    def backoff(self, attempt, retry_after=None):
+        wait = min(BACKOFF_BASE * (2 ** attempt), BACKOFF_CAP) + jitter(1.0, 4.0)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        return wait
+
+
+class CircuitBreaker:
+    """
+    Pausa global ante bloqueos. Cerrado: todo pasa. Abierto: `before_request()`
+    duerme hasta `open_until`. Semiabierto: pasa una sola petición de prueba
+    y las demás esperan su resultado.
+    """
+
+    def __init__(self):
+        self.state = "cerrado"
+        self.open_until = 0.0
+        self.trips = 0              # aperturas seguidas, para doblar la pausa
+        self.failures = 0           # fallas seguidas (5xx / red)
+        self.probing = False
+        self.counts = {"aperturas": 0, "segundos_abierto": 0.0}
+        self.cond = threading.Condition()
+
+    def before_request(self, deadline=None):
+        """
+        Espera a que el circuito deje pasar una petición. Devuelve False si
+        la pausa termina después de `deadline` (no tiene caso esperar).
+        """
+        waited = 0.0
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.state == "cerrado":
+                    break
+                if self.state == "abierto" and now >= self.open_until:
+                    self.state = "semiabierto"
+                if self.state == "semiabierto" and not self.probing:
+                    self.probing = threading.get_ident()
+                    break
+                remaining = self.open_until - now
+                if deadline is not None and time.time() + max(0.0, remaining) >= deadline:
+                    return False
+                if self.state == "abierto":
+                    # time.sleep y no cond.wait: el reloj del benchmark es virtual
+                    self.cond.release()
+                    try:
+                        time.sleep(remaining)
+                    finally:
+                        self.cond.acquire()
+                    waited += remaining
+                else:
+                    self.cond.wait(1.0)
+        if waited:
+            timing_add("backoff", waited)
+        return True
+
+    def _open(self, pause):
+        now = time.monotonic()
+        self.state = "abierto"
+        self.open_until = max(self.open_until, now + pause)
+        self.trips += 1
+        self.failures = 0
+        self.probing = False
+        self.counts["aperturas"] += 1
+        self.counts["segundos_abierto"] += pause
+        self.cond.notify_all()
+
+    def on_block(self, retry_after=None):
+        with self.cond:
+            if self.state == "abierto":
+                return      # otro worker ya lo abrió por la misma ráfaga
+            pause = min(BREAKER_BASE * (2 ** self.trips), BREAKER_CAP) + jitter(1.0, 4.0)
+            if retry_after is not None:
+                pause = max(pause, retry_after)
+            self._open(pause)
+        print(f"   🚧 Bloqueo del sitio: circuito abierto, todos en pausa {pause:.1f}s")
+
+    def on_failure(self):
+        with self.cond:
+            self.failures += 1
+            if self.state == "semiabierto" or self.failures >= BREAKER_FAILURES:
+                pause = min(BREAKER_BASE * (2 ** self.trips), BREAKER_CAP)
+                self._open(pause)
+                opened = pause
+            else:
+                opened = None
+        if opened is not None:
+            print(f"   🚧 Fallas seguidas del sitio: circuito abierto, todos en pausa {opened:.1f}s")
+
+    def release_probe(self):
+        """Suelta la prueba si la tomó este hilo y nadie la resolvió (excepción a media petición)."""
+        with self.cond:
+            if self.probing == threading.get_ident():
+                self.probing = False
+                self.cond.notify_all()
+
+    def on_success(self):
+        with self.cond:
+            if self.state == "semiabierto":
+                print("   ✅ Petición de prueba OK: circuito cerrado.")
+            self.state = "cerrado"
+            self.trips = 0
+            self.failures = 0
+            self.probing = False
+            self.cond.notify_all()
+
+
+retry_policy = RetryPolicy()
+breaker = CircuitBreaker()
+# Límite de main(): una pausa del circuito que lo rebase ya no se espera
+run_deadline = None
+
+# Se crea en main() a partir del estado guardado
+rate_controller = None
+# Se activa en main() cuando WORKERS > 1; en modo serial se queda en None
+rate_limiter = None
+_print_lock = threading.Lock()
+
+
+def get_rate_controller():
+    global rate_controller
+    if rate_controller is None:
+        rate_controller = AimdController.load()
+    return rate_controller
+
+
+def pause_initial(label):
+    if rate_limiter is not None:
+        return 0.0
+    initial_wait = planned_initial_wait()
+    print(f"   ⏳ Espera inicial antes de buscar {label}: {initial_wait:.1f}s (tasa AIMD: {get_rate_controller().rate:.2f} pet/min)")
+    sleep_until_fetch(initial_wait)
+    timing_add("espera", initial_wait)
+    return initial_wait
+
+
+def pause_between():
+    if rate_limiter is not None:
+        return 0.0
+    t = jitter(*BETWEEN_REQUESTS)
+    sleep_until_fetch(t)
+    timing_add("espera", t)
     return t
 
 
@@ -313,6 +1233,7 @@ def to_number(txt):
 
 
 def parse_first_product_url_from_search(html, current_url):
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html, "lxml")
     css_candidates = [
         "h2.productTitle a[href]",
@@ -332,7 +1253,149 @@ def parse_first_product_url_from_search(html, current_url):
     return None
 
 
+# ================= Extracción del detalle por niveles ==================
+# 1) "directo": árbol lxml + XPath para h1 / meta price / stockFlag, sin
+#    tocar el texto del documento (el caso normal).
+# 2) "texto": igual, pero el precio o el stock necesitan el respaldo por
+#    texto completo; ese texto se calcula una sola vez para ambos.
+# 3) "soup": el extractor original con BeautifulSoup, sólo si lxml falla
+#    (también con una página vacía o sólo comentarios, donde no hay árbol).
+# Los tres producen exactamente la misma tupla de cinco campos. No hay nivel
+# JSON-LD ni escaneo de bytes: no leen las mismas fuentes (título con el
+# texto anidado del h1, stockFlag) y la tupla dejaría de ser idéntica.
+
+def _xp_class(tag, cls):
+    return f"//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')]"
+
+
+class _LazyXPath:
+    """etree.XPath que se compila (e importa lxml) en la primera evaluación."""
+    __slots__ = ("expr", "compiled")
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.compiled = None
+
+    def __call__(self, node):
+        if self.compiled is None:
+            from lxml import etree
+            self.compiled = etree.XPath(self.expr)
+        return self.compiled(node)
+
+
+# BeautifulSoup no incluye en get_text() el texto de estos contenedores
+_TEXT_SKIP = "ancestor::script or ancestor::style or ancestor::template or ancestor::rt or ancestor::rp"
+
+_XP_TITLE_MAIN = _LazyXPath("(" + _xp_class("h1", "detailsInfo_right_title") + ")[1]")
+_XP_TITLE_ANY = _LazyXPath("(//h1)[1]")
+_XP_META_PRICE = _LazyXPath('(//meta[@itemprop="price"][@content])[1]')
+_XP_PRODUCT_PRICE = _LazyXPath('(//*[@id="productPrice"])[1]')
+_XP_PRICE_TEXT = _LazyXPath("(" + _xp_class("span", "priceText") + ")[1]")
+_XP_STOCK_FLAG = _LazyXPath("(" + _xp_class("div", "stock") + _xp_class("span", "stockFlag") + ")[1]")
+_XP_STOCK_FLAG_SPAN = _LazyXPath(
+    "(" + _xp_class("div", "stock") + _xp_class("span", "stockFlag") + "//span)[1]"
+)
+_XP_TEXT = _LazyXPath(f".//text()[not({_TEXT_SKIP})]")
+
+extract_tier_stats = {"directo": 0, "texto": 0, "soup": 0}
+_PRICE_RE = re.compile(r"\$\s*[\d\.,]+")
+_STOCK_FLAG_RE = re.compile(r"Disponibles?:\s*(\d+)", flags=re.I)
+_STOCK_BODY_RE = re.compile(r"Disponibles?\s*:?\s*(\d+)", flags=re.I)
+
+
+def _node_text(node, sep=""):
+    # Equivalente a Tag.get_text(sep, strip=True)
+    return sep.join(t.strip() for t in _XP_TEXT(node) if t.strip())
+
+
+def _first(xp, root):
+    found = xp(root)
+    return found[0] if found else None
+
+
+def _extract_all_from_product_lxml(html):
+    from lxml import etree
+    parser = etree.HTMLParser(recover=True)
+    parser.feed(html)
+    root = parser.close()
+    if root is None:
+        # Página vacía o sólo comentarios: libxml2 no arma árbol
+        raise ValueError("documento sin elementos")
+
+    body_cache = []
+
+    def body_text():
+        if not body_cache:
+            body_cache.append(_node_text(root, " "))
+        return body_cache[0]
+
+    title = ""
+    h1 = _first(_XP_TITLE_MAIN, root)
+    if h1 is None:
+        h1 = _first(_XP_TITLE_ANY, root)
+    if h1 is not None:
+        title = _node_text(h1)
+
+    price_text = ""
+    meta_price = _first(_XP_META_PRICE, root)
+    if meta_price is not None:
+        price_text = meta_price.get("content")
+    if not price_text:
+        price_span = _first(_XP_PRODUCT_PRICE, root)
+        if price_span is None:
+            price_span = _first(_XP_PRICE_TEXT, root)
+        if price_span is not None:
+            price_text = _node_text(price_span, " ")
+    if not price_text:
+        m = _PRICE_RE.search(body_text())
+        if m:
+            price_text = m.group(0)
+    price_num = to_number(price_text)
+
+    stock_text, stock_num = "", None
+    s1 = _first(_XP_STOCK_FLAG_SPAN, root)
+    if s1 is not None:
+        n = _node_text(s1)
+        if n.isdigit():
+            stock_num = int(n)
+            stock_text = f"Disponibles: {stock_num} pzas."
+    if stock_num is None:
+        s2 = _first(_XP_STOCK_FLAG, root)
+        if s2 is not None:
+            m = _STOCK_FLAG_RE.search(_node_text(s2, " "))
+            if m:
+                stock_num = int(m.group(1))
+                stock_text = f"Disponibles: {stock_num} pzas."
+    if stock_num is None:
+        body = body_text().lower()
+        if ("agotado" in body) or ("no disponible" in body):
+            stock_num = 0
+            stock_text = "Agotado"
+        else:
+            m = _STOCK_BODY_RE.search(body)
+            if m:
+                stock_num = int(m.group(1))
+                stock_text = f"Disponibles: {stock_num} pzas."
+
+    tier = "texto" if body_cache else "directo"
+    return tier, (title, (price_text or ""), price_num, (stock_text or ""), (stock_num if stock_num is not None else ""))
+
+
 def extract_all_from_product(html):
+    from lxml import etree
+    t0 = time.monotonic()
+    with stage("parseo"):
+        try:
+            tier, fields = _extract_all_from_product_lxml(html)
+        except (etree.Error, ValueError):
+            tier, fields = "soup", _extract_all_from_product_soup(html)
+    extract_tier_stats[tier] += 1
+    metrics.record_parse(tier, time.monotonic() - t0)
+    return fields
+
+
+def _extract_all_from_product_soup(html):
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html, "lxml")
     title = ""
     h1 = soup.select_one("h1.detailsInfo_right_title") or soup.find("h1")
@@ -383,86 +1446,1683 @@ def extract_all_from_product(html):
     return title, (price_text or ""), price_num, (stock_text or ""), (stock_num if stock_num is not None else "")
 
 
-recent_429 = []
+# ================= Listados: todos los productos de la página ==========
+_XP_LIST_ITEMS = _LazyXPath(_xp_class("li", "productData") + " | " + _xp_class("div", "emproduct")
+                             + "[not(ancestor::li[contains(concat(' ', normalize-space(@class), ' '), ' productData ')])]")
+_XP_LIST_TITLE = _LazyXPath(
+    "(.//a[contains(concat(' ', normalize-space(@class), ' '), ' emproduct_right_title ')][@href]"
+    " | .//a[substring(@href, string-length(@href) - 4) = '.html'])[1]"
+)
+_XP_LIST_ARTNUM = _LazyXPath(
+    "(.//*[contains(concat(' ', normalize-space(@class), ' '), ' emproduct_right_artnum ')])[1]"
+)
+_XP_LIST_PRICE = _LazyXPath(
+    "(.//*[contains(concat(' ', normalize-space(@class), ' '), ' emproduct_right_price ')]//label"
+    " | .//*[contains(concat(' ', normalize-space(@class), ' '), ' price ')])[1]"
+)
+_XP_LIST_STOCK = _LazyXPath("(.//*[contains(concat(' ', normalize-space(@class), ' '), ' emstock ')])[1]")
+_XP_NEXT_PAGE = _LazyXPath(
+    "(//a[@rel='next'][@href]"
+    " | //*[contains(concat(' ', normalize-space(@class), ' '), ' pagination ')]"
+    "//a[contains(concat(' ', normalize-space(@class), ' '), ' next ')][@href])[1]"
+)
+_ARTNUM_RE = re.compile(r"(?:SKU|Mod(?:elo)?)\s*:\s*(\S+)", flags=re.I)
 
 
-def current_429_ratio():
-    if not recent_429:
-        return 0.0
-    return sum(1 for x in recent_429 if x) / len(recent_429)
+def norm_sku(code):
+    return "".join((code or "").split()).upper()
 
 
-def planned_initial_wait():
-    base = jitter(*INITIAL_WAIT_RANGE)
-    ratio = current_429_ratio()
-    multiplier = 1.0 + ALPHA_SENSITIVITY * ratio
-    planned = base * multiplier
-    return planned
+def _listing_root(html):
+    """Raíz lxml de la página, o None si no hay elementos (vacía, sólo espacios o comentarios)."""
+    from lxml import etree
+    parser = etree.HTMLParser(recover=True)
+    try:
+        parser.feed(html)
+        return parser.close()
+    except etree.Error:
+        return None
 
 
-def get_with_backoff(url, allow_redirects=True, timeout=30, mark_429_flag=None):
-    last_status = None
-    for i in range(MAX_RETRIES):
-        try:
-            r = session.get(url, allow_redirects=allow_redirects, timeout=timeout)
-            last_status = r.status_code
-            if r.status_code in (200, 404):
-                return r
-            if r.status_code in (429, 403):
-                if mark_429_flag is not None:
-                    mark_429_flag[0] = True
-                wait = min(BACKOFF_BASE * (2 ** i), BACKOFF_CAP) + jitter(1.0, 4.0)
-                print(f"   HTTP {r.status_code} en {url} -> backoff {wait:.1f}s (reintento {i+1}/{MAX_RETRIES})")
-                time.sleep(wait)
-                continue
-            time.sleep(1.5 + i * 0.5)
-        except requests.RequestException as e:
-            wait = 2.0 + i * 1.25
-            print(f"   Error de red en {url}: {e} -> esperando {wait:.1f}s (reintento {i+1}/{MAX_RETRIES})")
-            time.sleep(wait)
-    return None
+def parse_listing_products(html, current_url):
+    """
+    Extrae todos los productos de una página de listado o de búsqueda:
+    lista de dicts con url, titulo, skus, precio y stock tal como aparecen
+    en la tarjeta del producto.
+    """
+    root = _listing_root(html)
+    if root is None:
+        return []
 
+    products = []
+    for item in _XP_LIST_ITEMS(root):
+        link = _first(_XP_LIST_TITLE, item)
+        if link is None:
+            continue
+        title = link.get("title") or _node_text(link, " ")
 
-COLUMNS = ["TIMESTAMP", "SKU", "URL_BUSQUEDA", "URL_PRODUCTO", "TITULO",
-           "PRECIO_TEXTO", "PRECIO_NUM", "STOCK_TEXTO", "STOCK_NUM", "STATUS"]
+        skus = set()
+        artnum = _first(_XP_LIST_ARTNUM, item)
+        for m in _ARTNUM_RE.finditer(_node_text(artnum if artnum is not None else item, " ")):
+            skus.add(norm_sku(m.group(1)))
 
+        price_text = ""
+        price = _first(_XP_LIST_PRICE, item)
+        if price is not None:
+            price_text = _node_text(price, " ")
 
-def row_to_tsv(row: dict) -> str:
-    def fmt(x):
-        if x is None:
-            return ""
-        s = str(x)
-        return s.replace("\t", " ").replace("\r", " ").replace("\n", " ").strip()
-    return "\t".join(fmt(row.get(col, "")) for col in COLUMNS)
+        stock_text, stock_num = "", ""
+        stock = _first(_XP_LIST_STOCK, item)
+        if stock is not None:
+            txt = _node_text(stock, " ")
+            m = re.search(r"Disponibles?\s*:?\s*(\d+)", txt, flags=re.I)
+            if m:
+                stock_num = int(m.group(1))
+                stock_text = f"Disponibles: {stock_num} pzas."
+            elif ("agotado" in txt.lower()) or ("no disponible" in txt.lower()):
+                stock_num = 0
+                stock_text = "Agotado"
 
+        products.append({
+            "url": urljoin(current_url, link.get("href")),
+            "titulo": title,
+            "skus": sorted(skus),
+            "precio_texto": price_text,
+            "precio_num": to_number(price_text),
+            "stock_texto": stock_text,
+            "stock_num": stock_num,
+        })
+    return products
 
-def print_header_once():
-    print("\t".join(COLUMNS))
-    sys.stdout.flush()
 
+def parse_next_page_url(html, current_url):
+    root = _listing_root(html)
+    if root is None:
+        return None
+    link = _first(_XP_NEXT_PAGE, root)
+    if link is None:
+        return None
+    return urljoin(current_url, link.get("href"))
 
-# ================= Carga de códigos por LOOP =======================
-def load_codes_for_loop(loop_index: int):
+
+def crawl_categories(codes, deadline=None):
     """
-    LOOP 1: lee de INPUT_CODES
-    LOOP 2: lee de 'cyberpuerta_pending_codes_loop1.txt'
-    LOOP 3: lee de 'cyberpuerta_pending_codes_loop2.txt'
+    Recorre INPUT_CATEGORY_URLS página por página y arma filas para los
+    SKUs de `codes` que aparezcan en los listados. Devuelve
+    {sku_original: fila}.
     """
-    if loop_index == 1:
-        codes = [ln.strip() for ln in INPUT_CODES.splitlines() if ln.strip()]
-        print(f"📥 Cargando {len(codes)} códigos desde INPUT_CODES embebido (loop 1).")
-        return codes
+    wanted = {norm_sku(c): c for c in codes}
+    found = {}
+    pages = 0
+    for start_url in INPUT_CATEGORY_URLS:
+        url = start_url.strip()
+        seen = set()
+        for _ in range(CATEGORY_MAX_PAGES):
+            if not url or url in seen or len(found) == len(wanted):
+                break
+            if deadline is not None and time.time() >= deadline:
+                print("⏹️ Límite de tiempo alcanzado durante el recorrido de listados.")
+                return found
+            seen.add(url)
+            pause_initial("listado")
+            r = get_with_backoff(url, kind="listado")
+            pages += 1
+            if not r or r.status_code != 200:
+                print(f"   ⚠️ Listado {url} -> {None if r is None else r.status_code}, se omite.")
+                break
+            ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            matched = 0
+            with stage("parseo", tier="listado"):
+                products = parse_listing_products(r.text, r.url)
+            for prod in products:
+                for key in prod["skus"]:
+                    code = wanted.get(key)
+                    if code is None or code in found:
+                        continue
+                    matched += 1
+                    # Sólo la URL: el título de la tarjeta puede venir recortado y
+                    # el del detalle es el que process_code compara después.
+                    url_cache_put(code, prod["url"], "")
+                    found[code] = {
+                        "TIMESTAMP": ts,
+                        "SKU": code,
+                        "URL_BUSQUEDA": r.url,
+                        "URL_PRODUCTO": prod["url"],
+                        "TITULO": prod["titulo"],
+                        "PRECIO_TEXTO": prod["precio_texto"],
+                        "PRECIO_NUM": prod["precio_num"] if prod["precio_num"] is not None else "",
+                        "STOCK_TEXTO": prod["stock_texto"],
+                        "STOCK_NUM": prod["stock_num"],
+                        "STATUS": "OK (listado)",
+                    }
+            print(f"   📋 Listado {url}: {matched} SKUs resueltos (total {len(found)}/{len(wanted)}).")
+            url = parse_next_page_url(r.text, r.url)
+    print(f"📋 Listados: {pages} páginas, {len(found)} SKUs resueltos sin búsqueda individual.")
+    return found
 
-    prev = loop_index - 1
-    pending_file = f"cyberpuerta_pending_codes_loop{prev}.txt"
+
+class SearchHarvest:
+    """
+    Las páginas de búsqueda traen tarjetas de otros productos (variantes de
+    capacidad, color...). Las que corresponden a SKUs todavía pendientes en
+    la corrida dejan su URL en url_cache, así ese SKU va directo al detalle
+    y se ahorra su propia búsqueda.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.counts = {"urls_cosechadas": 0}
+
+    def reset(self, codes=()):
+        with self.lock:
+            self.pending = {norm_sku(c): c for c in codes}
+            self.counts = {"urls_cosechadas": 0}
+
+    def done(self, code):
+        with self.lock:
+            self.pending.pop(norm_sku(code), None)
+
+    def harvest(self, html, current_url, code):
+        with self.lock:
+            if not self.pending or URL_CACHE_DAYS <= 0:
+                return
+        with stage("parseo", tier="busqueda"):
+            products = parse_listing_products(html, current_url)
+        for prod in products:
+            for key in prod["skus"]:
+                with self.lock:
+                    other = self.pending.get(key)
+                    if other is None or other == code:
+                        continue
+                    del self.pending[key]
+                # Sólo cuenta lo que quedó guardado (con URL_CACHE_DAYS <= 0 no se guarda nada)
+                if url_cache_get(other) is None and url_cache_put(other, prod["url"], ""):
+                    with self.lock:
+                        self.counts["urls_cosechadas"] += 1
+
+
+search_harvest = SearchHarvest()
+
+
+# ================= Caché SKU -> URL de producto =======================
+def _norm_title(t):
+    return " ".join((t or "").split()).lower()
+
+
+def url_cache_get(sku):
+    if URL_CACHE_DAYS <= 0:
+        return None
+    with _db_lock:
+        row = get_db().execute(
+            "SELECT url, titulo, actualizado FROM url_cache WHERE sku = ?", (sku,)
+        ).fetchone()
+    if not row:
+        return None
+    url, titulo, actualizado = row
+    if time.time() - actualizado > URL_CACHE_DAYS * 86400.0:
+        url_cache_invalidate(sku)
+        return None
+    return url, titulo
+
+
+def url_cache_peek(sku):
+    """Como url_cache_get pero sin borrar la entrada vencida (para estimar, p. ej. en --dry-run)."""
+    if URL_CACHE_DAYS <= 0:
+        return None
+    with _db_lock:
+        row = get_db().execute(
+            "SELECT url, titulo FROM url_cache WHERE sku = ? AND actualizado >= ?",
+            (sku, time.time() - URL_CACHE_DAYS * 86400.0),
+        ).fetchone()
+    return tuple(row) if row else None
+
+
+def url_cache_put(sku, url, titulo):
+    """Guarda SKU -> URL; devuelve False si el caché está apagado o faltan datos."""
+    if URL_CACHE_DAYS <= 0 or not sku or not url:
+        return False
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO url_cache (sku, url, titulo, actualizado) VALUES (?, ?, ?, ?)",
+                (sku, url, titulo or "", time.time()),
+            )
+    return True
+
+
+def url_cache_invalidate(sku):
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute("DELETE FROM url_cache WHERE sku = ?", (sku,))
+
+
+# ================= Caché HTTP de páginas de detalle ====================
+http_cache_stats = {"detalle": 0, "condicionales": 0, "no_modificado": 0, "completas": 0}
+_http_cache_lock = threading.Lock()
+
+
+def _bump_http_stat(key):
+    with _http_cache_lock:
+        http_cache_stats[key] += 1
+
+
+def http_cache_validators(url):
+    with _db_lock:
+        row = get_db().execute(
+            "SELECT etag, last_modified FROM http_cache WHERE url = ?", (url,)
+        ).fetchone()
+    headers = {}
+    if row:
+        etag, last_modified = row
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def http_cache_fields(url):
+    with _db_lock:
+        row = get_db().execute(
+            "SELECT cuerpo, campos FROM http_cache WHERE url = ?", (url,)
+        ).fetchone()
+    if not row:
+        return None
+    cuerpo, campos = row
+    if campos:
+        return tuple(json.loads(campos))
+    if cuerpo:
+        return extract_all_from_product(zlib.decompress(cuerpo).decode("utf-8", "replace"))
+    return None
+
+
+def http_cache_store(url, r, fields):
+    etag = r.headers.get("ETag")
+    last_modified = r.headers.get("Last-Modified")
+    if not (etag or last_modified):
+        return
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO http_cache "
+                "(url, etag, last_modified, cuerpo, campos, actualizado) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, zlib.compress(r.content),
+                 json.dumps(list(fields), ensure_ascii=False), time.time()),
+            )
+
+
+# ================= Archivo de páginas crudas (opcional) =================
+# Con CYBERPUERTA_ARCHIVO=<carpeta> cada búsqueda y detalle con 200 se
+# guarda comprimido bajo el sha256 de su cuerpo (una página que no cambió
+# ocupa lugar una sola vez) y la tabla `archivo` indexa cada captura por
+# SKU y fecha, con su URL, status y codificación. `reextract` vuelve a
+# correr el extractor sobre lo archivado sin tocar la red.
+ARCHIVE_DIR = os.environ.get("CYBERPUERTA_ARCHIVO", "")
+
+
+def archive_path(digest, root=None):
+    return os.path.join(root or ARCHIVE_DIR, digest[:2], digest + ".html.gz")
+
+
+def archive_page(key, kind, r):
+    if not ARCHIVE_DIR or r is None or r.status_code != 200:
+        return
+    import gzip
+    body = r.content
+    digest = hashlib.sha256(body).hexdigest()
+    path = archive_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(gzip.compress(body, mtime=0))
+        os.replace(tmp, path)
+    now = time.time()
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute(
+                "INSERT INTO archivo (sku, ts, fecha, corrida, tipo, url, status, codificacion, sha256, bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, now, datetime.fromtimestamp(now).strftime("%Y-%m-%d"), RUN_ID, kind, r.url,
+                 r.status_code, r.encoding, digest, len(body)),
+            )
+
+
+def archive_entries(since=None, until=None, keys=None, latest=False):
+    """Capturas de detalle del archivo, por SKU y fecha (AAAA-MM-DD, inclusivas)."""
+    sql = "SELECT sku, ts, url, codificacion, sha256 FROM archivo WHERE tipo = 'detalle' AND status = 200"
+    params = []
+    if since:
+        sql += " AND fecha >= ?"
+        params.append(since)
+    if until:
+        sql += " AND fecha <= ?"
+        params.append(until)
+    if keys:
+        sql += f" AND sku IN ({','.join('?' * len(keys))})"
+        params.extend(keys)
+    with _db_lock:
+        rows = get_db().execute(sql + " ORDER BY sku, ts", params).fetchall()
+    entries = [dict(zip(("sku", "ts", "url", "codificacion", "sha256"), row)) for row in rows]
+    if latest:
+        entries = list({(e["sku"], e["url"]): e for e in entries}.values())
+    return entries
+
+
+def _reextract_page(job):
+    # Corre en otro proceso: sólo recibe y devuelve datos que se pueden picklear
+    import gzip
+    path, encoding = job
+    try:
+        with gzip.open(path, "rb") as f:
+            html = f.read().decode(encoding or "utf-8", errors="replace")
+    except FileNotFoundError:
+        return None
+    return extract_all_from_product(html)
+
+
+def reextract(out_base="cyberpuerta_reextraido", since=None, until=None, keys=None, latest=False,
+              processes=None, formats=None):
+    """
+    Vuelve a extraer los campos de cada detalle archivado, repartiendo las
+    páginas entre los núcleos. Escribe filas con las mismas columnas que
+    una corrida (TIMESTAMP = momento de la captura) y devuelve
+    (filas, {formato: archivo}).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    entries = archive_entries(since, until, keys, latest)
+    processes = processes or os.cpu_count() or 1
+    print(f"🗃️ Reextrayendo {len(entries)} páginas archivadas con {processes} procesos…")
+    jobs = [(archive_path(e["sha256"]), e["codificacion"]) for e in entries]
+    csv_name = f"{out_base}.csv"
+    sink = CsvRowSink(csv_name)
+    missing = 0
+    t0 = time.monotonic()
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            chunk = max(1, len(jobs) // (processes * 8))
+            for e, fields in zip(entries, pool.map(_reextract_page, jobs, chunksize=chunk)):
+                title, p_txt, p_num, s_txt, s_num = fields or ("", "", "", "", "")
+                missing += fields is None
+                # La clave es el SKU o, para los ítems dados por URL, la URL (como row_key)
+                is_url = e["sku"].startswith(("http://", "https://"))
+                sink.write({
+                    "TIMESTAMP": datetime.fromtimestamp(e["ts"]).strftime("%Y-%m-%d %H:%M:%S"),
+                    "SKU": "" if is_url else e["sku"],
+                    "URL_BUSQUEDA": e["sku"] if is_url else "",
+                    "URL_PRODUCTO": e["url"],
+                    "TITULO": title, "PRECIO_TEXTO": p_txt, "PRECIO_NUM": p_num,
+                    "STOCK_TEXTO": s_txt, "STOCK_NUM": s_num,
+                    "STATUS": "OK" if fields is not None else "Archivo faltante",
+                })
+    finally:
+        sink.close()
+    elapsed = time.monotonic() - t0
+    rate = len(entries) / elapsed if elapsed else 0.0
+    print(f"   {len(entries)} páginas en {elapsed:.1f}s ({rate:.0f}/s), {missing} sin archivo.")
+    return export_outputs(csv_name, formats)
+
+
+def product_fields(url, r, key=""):
+    """
+    Los cinco campos del detalle a partir de la respuesta. Con un 304 se
+    reusan los extraídos en la corrida anterior sin volver a parsear; si no
+    hay copia guardada se pide una vez la página completa, sin validadores.
+    """
+    if r is None or r.status_code == 404:
+        return None
+    if r.status_code == 304:
+        _bump_http_stat("no_modificado")
+        fields = http_cache_fields(url)
+        if fields is not None:
+            return fields
+        print(f"   ♻️ 304 sin copia en caché para {url}, se pide la página completa.")
+        r = get_with_backoff(url, kind="detalle")
+        if r is None or r.status_code in (304, 404):
+            return None
+    archive_page(key, "detalle", r)
+    fields = extract_all_from_product(r.text)
+    if HTTP_CACHE:
+        _bump_http_stat("completas")
+        http_cache_store(url, r, fields)
+    return fields
+
+
+# ================= Reuso de páginas de detalle en la corrida ============
+# Variantes de empaque de un mismo producto (SDCS2/128GB y SDCS2/128GBSP,
+# DTXM/64GB y DTXM/64GB-2P) suelen resolver a la misma página. La primera
+# visita a una URL de detalle guarda sus campos; cualquier otro SKU que
+# resuelva a ella en la misma corrida los reusa sin pedirla otra vez (y,
+# si la URL venía del caché SKU -> URL, sin la espera inicial). Con varios
+# workers, quien llega a una URL en vuelo espera a la primera petición en
+# vez de repetirla.
+class ProductPageCache:
+    def __init__(self, max_age=None):
+        self.lock = threading.Lock()
+        self.reset(max_age)
+
+    def reset(self, max_age=None):
+        """Vacía el caché; `max_age` (s) limita el reuso en el modo continuo."""
+        with self.lock:
+            self.max_age = max_age
+            self.entries = {}       # url -> (momento, status, campos)
+            self.inflight = {}      # url -> threading.Event
+            self.counts = {"paginas_reusadas": 0, "esperas_ahorradas": 0}
+
+    def _fresh(self, url):
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if self.max_age is not None and time.monotonic() - entry[0] > self.max_age:
+            del self.entries[url]
+            return None
+        return entry[1], entry[2]
+
+    def has_fields(self, url):
+        with self.lock:
+            hit = self._fresh(url)
+        return hit is not None and hit[1] is not None
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def fetch(self, url, key=""):
+        """(status, campos) de la página; sólo se pide si nadie la trajo ya."""
+        while True:
+            with self.lock:
+                hit = self._fresh(url)
+                if hit is not None:
+                    self.counts["paginas_reusadas"] += 1
+                    return hit
+                event = self.inflight.get(url)
+                if event is None:
+                    event = self.inflight[url] = threading.Event()
+                    break
+            # Si la petición en vuelo falla, el siguiente intento lo hace este hilo
+            event.wait()
+        try:
+            r = get_with_backoff(url, conditional=True, kind="detalle")
+            status = None if r is None else r.status_code
+            fields = product_fields(url, r, key)
+            if fields is not None or status == 404:
+                with self.lock:
+                    self.entries[url] = (time.monotonic(), status, fields)
+            return status, fields
+        finally:
+            with self.lock:
+                del self.inflight[url]
+            event.set()
+
+
+product_pages = ProductPageCache()
+
+
+def fetch_product(url, key=""):
+    """(status o None, campos o None) del detalle, reusando lo ya traído en la corrida."""
+    return product_pages.fetch(url, key)
+
+
+def planned_initial_wait():
+    base = jitter(*INITIAL_WAIT_RANGE)
+    return base * get_rate_controller().slowdown()
+
+
+def _record_fetch(kind, r, t0, t_head, t_end):
+    conn = _timing.conn
+    phases = {
+        "dns": conn["dns"],
+        "conexion": conn["conexion"],
+        "ttfb": max(0.0, t_head - t0 - conn["dns"] - conn["conexion"]),
+        "descarga": t_end - t_head,
+    }
+    try:
+        wire = r.raw.tell()
+    except (AttributeError, OSError):
+        wire = len(r.content)
+    metrics.record_fetch(kind, r.status_code, phases, wire, len(r.content))
+    metrics.record_connection("nuevas" if conn["dns"] or conn["conexion"] else "reusadas")
+
+
+def get_with_backoff(url, allow_redirects=True, timeout=30, conditional=False, kind="pagina"):
+    """
+    GET con la política de reintentos de la corrida. Devuelve la respuesta
+    (200, 404 o 304 condicional) o None si se agotan los intentos, el
+    presupuesto de reintentos o el tiempo de la corrida.
+    """
+    import requests
+    controller = get_rate_controller()
+    headers = None
+    if conditional and HTTP_CACHE:
+        _bump_http_stat("detalle")
+        headers = http_cache_validators(url) or None
+        if headers:
+            _bump_http_stat("condicionales")
+    retry_policy.on_request()
+    attempts = retry_policy.max_attempts
+    for i in range(attempts):
+        if i and not retry_policy.try_spend():
+            print(f"   Presupuesto de reintentos agotado: {url} queda para después.")
+            return None
+        if not breaker.before_request(run_deadline):
+            print(f"   La pausa del circuito rebasa el límite de la corrida: {url} queda para después.")
+            return None
+        # Si algo inesperado revienta a media petición, la prueba del circuito
+        # semiabierto no puede quedarse tomada: los demás workers esperarían para siempre
+        try:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            try:
+                drop_stale_connections(url)
+                _timing.conn = {"dns": 0.0, "conexion": 0.0}
+                t0 = time.monotonic()
+                try:
+                    # stream=True para separar la espera del primer byte de la descarga
+                    r = get_session().get(url, allow_redirects=allow_redirects, timeout=timeout,
+                                    headers=headers, stream=True)
+                    t_head = time.monotonic()
+                    r.content
+                finally:
+                    timing_add("red", time.monotonic() - t0)
+            except requests.RequestException as e:
+                metrics.record_retry(type(e).__name__)
+                breaker.on_failure()
+                if i + 1 < attempts:
+                    wait = retry_policy.backoff(i)
+                    print(f"   Error de red en {url}: {e} -> esperando {wait:.1f}s (intento {i+1}/{attempts})")
+                    time.sleep(wait)
+                    timing_add("backoff", wait)
+                continue
+            t_end = time.monotonic()
+            note_connection_use(r.url, r.headers)
+            _record_fetch(kind, r, t0, t_head, t_end)
+            controller.on_response(r.status_code, t_end - t0)
+            if r.status_code in (200, 404) or (headers and r.status_code == 304):
+                breaker.on_success()
+                return r
+            metrics.record_retry(str(r.status_code))
+            retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            if r.status_code in (429, 403):
+                # La espera la hace el circuito, para todos los workers a la vez
+                print(f"   HTTP {r.status_code} en {url} (intento {i+1}/{attempts})")
+                breaker.on_block(retry_after)
+                continue
+            breaker.on_failure()
+            if i + 1 < attempts:
+                wait = retry_policy.backoff(i, retry_after)
+                print(f"   HTTP {r.status_code} en {url} -> backoff {wait:.1f}s (intento {i+1}/{attempts})")
+                time.sleep(wait)
+                timing_add("backoff", wait)
+        finally:
+            breaker.release_probe()
+    return None
+
+COLUMNS = ["TIMESTAMP", "SKU", "URL_BUSQUEDA", "URL_PRODUCTO", "TITULO",
+           "PRECIO_TEXTO", "PRECIO_NUM", "STOCK_TEXTO", "STOCK_NUM", "STATUS"]
+
+
+def row_to_tsv(row: dict) -> str:
+    def fmt(x):
+        if x is None:
+            return ""
+        s = str(x)
+        return s.replace("\t", " ").replace("\r", " ").replace("\n", " ").strip()
+    return "\t".join(fmt(row.get(col, "")) for col in COLUMNS)
+
+
+# ================= Salida incremental (crash-safe) =====================
+# Cada fila se agrega al CSV en cuanto se produce: flush inmediato y fsync
+# cada SINK_FSYNC_EVERY filas. Si el runner muere a media corrida, lo ya
+# scrapeado queda en disco, y la memoria no crece con el número de SKUs.
+SINK_FSYNC_EVERY = int(os.environ.get("CYBERPUERTA_FSYNC_CADA", "10"))
+
+
+class CsvRowSink:
+    def __init__(self, path, append=False):
+        self.path = path
+        fresh = not (append and os.path.isfile(path) and os.path.getsize(path) > 0)
+        # utf-8-sig sólo al crear el archivo: en modo append repetiría el BOM
+        self.f = open(path, "w" if fresh else "a", encoding="utf-8-sig" if fresh else "utf-8", newline="")
+        self.writer = csv.DictWriter(self.f, fieldnames=COLUMNS, extrasaction="ignore")
+        if fresh:
+            self.writer.writeheader()
+        self.unsynced = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, row):
+        with self.lock:
+            self.writer.writerow({col: ("" if row.get(col) is None else row.get(col)) for col in COLUMNS})
+            self.f.flush()
+            self.count += 1
+            self.unsynced += 1
+            if self.unsynced >= SINK_FSYNC_EVERY:
+                os.fsync(self.f.fileno())
+                self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if self.f.closed:
+                return
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+
+
+# Se abre en main(); todas las filas pasan por emit_row()
+row_sink = None
+
+
+def emit_row(row):
+    if row_sink is not None:
+        row_sink.write(row)
+    # Antes de history_append: las reglas comparan contra la observación anterior
+    engine = get_alert_engine()
+    if engine:
+        engine.evaluate(row)
+    history_append(row)
+
+
+# ================= Exportación (xlsx / parquet) ========================
+# El CSV es la salida primaria (crash-safe). Los demás formatos se derivan de
+# él en una sola pasada, fila por fila y con memoria constante: cada sink
+# tiene write(row) y close() igual que CsvRowSink.
+OUTPUT_FORMATS = ("csv", "xlsx", "parquet")
+OUTPUTS = [f.strip() for f in os.environ.get("CYBERPUERTA_SALIDAS", "csv,xlsx").split(",") if f.strip()]
+URL_COLUMNS = ("URL_BUSQUEDA", "URL_PRODUCTO")
+XLSX_MAX_URLS = 65530        # hipervínculos por hoja que acepta Excel
+XLSX_MAX_URL_LEN = 2079      # URLs más largas no pueden ser hipervínculo
+PARQUET_BATCH = 5000         # filas por row group
+
+
+def typed_row(row):
+    """Fila del CSV con PRECIO_NUM y STOCK_NUM como números (None si vienen vacíos)."""
+    out = {col: row.get(col) or "" for col in COLUMNS}
+    out["PRECIO_NUM"] = _num_or_none(row.get("PRECIO_NUM"))
+    stock = _num_or_none(row.get("STOCK_NUM"))
+    out["STOCK_NUM"] = None if stock is None else int(stock)
+    return out
+
+
+class XlsxRowSink:
+    def __init__(self, path):
+        self.path = path
+        # constant_memory: cada fila se escribe a disco en cuanto se termina
+        import xlsxwriter
+        self.wb = xlsxwriter.Workbook(path, {"constant_memory": True, "strings_to_urls": False,
+                                             "strings_to_numbers": False, "strings_to_formulas": False})
+        self.ws = self.wb.add_worksheet("Datos")
+        self.ws.write_row(0, 0, COLUMNS)
+        self.url_cols = {COLUMNS.index(c) for c in URL_COLUMNS}
+        self.urls = 0
+        self.count = 0
+
+    def write(self, row):
+        row = typed_row(row)
+        r = self.count + 1
+        for c, col in enumerate(COLUMNS):
+            val = row[col]
+            if val is None or val == "":
+                continue
+            if isinstance(val, (int, float)):
+                self.ws.write_number(r, c, val)
+            elif (c in self.url_cols and val.startswith("http")
+                  and len(val) <= XLSX_MAX_URL_LEN and self.urls < XLSX_MAX_URLS):
+                self.ws.write_url(r, c, val, string=val)
+                self.urls += 1
+            else:
+                self.ws.write_string(r, c, val)
+        self.count += 1
+
+    def close(self):
+        if self.urls >= XLSX_MAX_URLS:
+            print(f"⚠️ '{self.path}': Excel admite {XLSX_MAX_URLS} hipervínculos por hoja; "
+                  f"las URLs restantes quedaron como texto.")
+        self.wb.close()
+
+
+class ParquetRowSink:
+    def __init__(self, path):
+        # pyarrow es opcional: sólo hace falta si se pide parquet
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([
+            (col, pa.float64() if col == "PRECIO_NUM" else pa.int64() if col == "STOCK_NUM" else pa.string())
+            for col in COLUMNS
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batch = []
+        self.count = 0
+
+    def _flush(self):
+        if self.batch:
+            self.writer.write_table(self.pa.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def write(self, row):
+        self.batch.append(typed_row(row))
+        self.count += 1
+        if len(self.batch) >= PARQUET_BATCH:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+SINKS = {"xlsx": XlsxRowSink, "parquet": ParquetRowSink}
+
+
+def export_outputs(csv_name, formats=None):
+    """
+    Deriva del CSV los formatos pedidos (además del propio CSV) en una sola
+    lectura. Devuelve (filas, {formato: archivo}).
+    """
+    formats = OUTPUTS if formats is None else formats
+    base = os.path.splitext(csv_name)[0]
+    sinks = {}
+    for fmt in formats:
+        if fmt not in SINKS:
+            continue
+        try:
+            sinks[fmt] = SINKS[fmt](f"{base}.{fmt}")
+        except ImportError as e:
+            print(f"⚠️ No se genera {fmt}: falta la dependencia opcional ({e.name}).")
+    n = 0
+    try:
+        with open(csv_name, encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                for sink in sinks.values():
+                    sink.write(row)
+                n += 1
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    paths = {"csv": csv_name}
+    paths.update((fmt, f"{base}.{fmt}") for fmt in sinks)
+    return n, paths
+
+
+def print_header_once():
+    print("\t".join(COLUMNS))
+    sys.stdout.flush()
+
+
+# ================= Sharding entre runners ===============================
+def parse_shard(value):
+    m = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", value or "")
+    if not m or not (1 <= int(m.group(1)) <= int(m.group(2))):
+        raise ValueError(f"shard inválido '{value}', se espera i/N con 1 <= i <= N")
+    return int(m.group(1)), int(m.group(2))
+
+
+def set_shard(shard):
+    """Activa el shard (i, N): cambia el id de corrida y los nombres de salida."""
+    global SHARD, RUN_ID
+    SHARD = shard
+    if shard is not None:
+        RUN_ID = f"{RUN_ID}{run_id_suffix()}"
+
+
+def run_id_suffix():
+    return "" if SHARD is None else f"-shard{SHARD[0]}of{SHARD[1]}"
+
+
+def shard_of(value, n):
+    # Hash estable (no hash() de Python, que cambia entre procesos)
+    digest = hashlib.sha1(norm_sku(value).encode("utf-8")).hexdigest()
+    return int(digest, 16) % n + 1
+
+
+def in_shard(value):
+    return SHARD is None or shard_of(value, SHARD[1]) == SHARD[0]
+
+
+def output_suffix():
+    return "" if SHARD is None else f"_shard{SHARD[0]}of{SHARD[1]}"
+
+
+def merge_shards(paths=None, out_base="cyberpuerta_datos"):
+    """
+    Combina los CSV de los shards en un solo reporte y revisa cobertura
+    contra INPUT_CODES / INPUT_URLS. De cada shard se toma el CSV del loop
+    más alto, que ya trae la corrida completa. Todos los CSV tienen que ser
+    del mismo reparto (mismo N): restos de una corrida con otro número de
+    shards duplicarían o taparían filas sin avisar.
+    """
+    if not paths:
+        latest = {}
+        for path in glob.glob("cyberpuerta_datos_loop*_shard*of*.csv"):
+            m = re.search(r"_loop(\d+)_(shard\d+of\d+)\.csv$", path)
+            if m and int(m.group(1)) >= latest.get(m.group(2), (0, ""))[0]:
+                latest[m.group(2)] = (int(m.group(1)), path)
+        paths = [path for _, path in sorted(latest.values(), key=lambda x: x[1])]
+    if not paths:
+        raise FileNotFoundError("No encontré CSVs de shards (cyberpuerta_datos_loop*_shard*of*.csv).")
+    by_n = {}
+    for path in paths:
+        m = re.search(r"_shard\d+of(\d+)\.csv$", path)
+        by_n.setdefault(int(m.group(1)) if m else None, []).append(path)
+    if len(by_n) > 1:
+        detalle = "; ".join(
+            f"{'sin shard' if n is None else f'N={n}'}: {', '.join(sorted(ps))}"
+            for n, ps in sorted(by_n.items(), key=lambda x: (x[0] is None, x[0] or 0))
+        )
+        raise ValueError(f"Los CSV son de repartos distintos, no se combinan ({detalle}).")
+
+    rows = {}
+    for path in paths:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            n = 0
+            for row in csv.DictReader(f):
+                key = norm_sku(row["SKU"]) if row.get("SKU") else row.get("URL_BUSQUEDA", "")
+                prev = rows.get(key)
+                # Si dos shards traen el mismo SKU, gana la fila OK
+                if prev is None or not str(prev.get("STATUS", "")).startswith("OK"):
+                    rows[key] = row
+                n += 1
+        print(f"🧩 {path}: {n} filas.")
+
+    expected = [norm_sku(ln) for ln in INPUT_CODES.splitlines() if ln.strip()]
+    expected += [u.strip() for u in INPUT_URLS if u.strip()]
+    order = {key: pos for pos, key in enumerate(dict.fromkeys(expected))}
+    missing = [key for key in order if key not in rows]
+
+    csv_name = f"{out_base}.csv"
+    with open(csv_name, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        for key in sorted(rows, key=lambda k: (order.get(k, len(order)), k)):
+            writer.writerow(rows[key])
+    _, outputs = export_outputs(csv_name)
+
+    print(f"✅ Merge: {len(rows)} filas de {len(paths)} shards en {', '.join(repr(p) for p in outputs.values())}.")
+    if missing:
+        missing_file = f"{out_base}_faltantes.txt"
+        with open(missing_file, "w", encoding="utf-8") as f:
+            for key in missing:
+                f.write(key + "\n")
+        print(f"⚠️ Cobertura incompleta: faltan {len(missing)}/{len(order)} ítems (ver '{missing_file}').")
+    else:
+        print(f"✅ Cobertura completa: {len(order)}/{len(order)} ítems.")
+    return outputs
+
+
+# ================= Carga de códigos por LOOP =======================
+def unique_codes(codes):
+    """
+    Descarta los códigos repetidos que sólo difieren en mayúsculas o
+    espacios ('SDCS2/128GB' y 'sdcs2/ 128GB'), para que ninguno cueste dos
+    veces. norm_sku es sólo la clave de comparación: se conserva la primera
+    forma, recortada y con los espacios internos colapsados a uno (los
+    modelos de varias palabras, 'AORUS 15 9MF-E2LA583', se buscan así), y
+    el orden.
+    """
+    seen = {}
+    n = 0
+    for code in codes:
+        clean = " ".join(code.split())
+        if clean:
+            n += 1
+            seen.setdefault(norm_sku(clean), clean)
+    if n > len(seen):
+        print(f"🧹 {n - len(seen)} códigos repetidos (mayúsculas/espacios) se procesan una sola vez.")
+    return list(seen.values())
+
+
+def input_codes():
+    return unique_codes(INPUT_CODES.splitlines())
+
+
+def input_urls():
+    return list(dict.fromkeys(u.strip() for u in INPUT_URLS if u.strip()))
+
+
+def load_codes_for_loop(loop_index: int):
+    """
+    Sólo se usa cuando la corrida todavía no tiene journal:
+    LOOP 1: lee de INPUT_CODES
+    LOOP n: lee de 'cyberpuerta_pending_codes_loop{n-1}.txt'
+    """
+    if loop_index == 1:
+        codes = input_codes()
+        print(f"📥 Cargando {len(codes)} códigos desde INPUT_CODES embebido (loop 1).")
+        return codes
+
+    prev = loop_index - 1
+    pending_file = f"cyberpuerta_pending_codes_loop{prev}{output_suffix()}.txt"
     if os.path.isfile(pending_file):
         with open(pending_file, encoding="utf-8") as f:
-            codes = [ln.strip() for ln in f if ln.strip()]
+            codes = unique_codes(f)
         print(f"📥 Cargando {len(codes)} códigos pendientes desde '{pending_file}' (loop {loop_index}).")
         return codes
     else:
-        print(f"ℹ️ No encontré '{pending_file}'. No hay códigos pendientes para loop {loop_index}.")
-        return []
+        print(f"ℹ️ No encontré '{pending_file}'. No hay códigos pendientes para loop {loop_index}.")
+        return []
+
+
+# ================= Journal por SKU (reanudación) =======================
+# Estados: pendiente -> en_curso -> hecho | fallido. Un ítem "en_curso" al
+# arrancar significa que el proceso anterior murió a media petición: vuelve a
+# pendiente. Los fallidos (excepción) se reintentan en el siguiente arranque
+# hasta JOURNAL_MAX_ATTEMPTS.
+_FINAL_SQL = "(estado = 'hecho' OR (estado = 'fallido' AND intentos >= ?))"
+_OPEN_SQL = "(estado IN ('pendiente', 'en_curso') OR (estado = 'fallido' AND intentos < ?))"
+
+
+def journal_counts(run_id=None):
+    with _db_lock:
+        rows = get_db().execute(
+            "SELECT estado, COUNT(*) FROM jobs WHERE corrida = ? GROUP BY estado",
+            (run_id or RUN_ID,),
+        ).fetchall()
+    return dict(rows)
+
+
+def journal_seed(items, run_id=None):
+    run_id = run_id or RUN_ID
+    now = time.time()
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.executemany(
+                "INSERT OR IGNORE INTO jobs (corrida, pos, tipo, valor, estado, actualizado) "
+                "VALUES (?, ?, ?, ?, 'pendiente', ?)",
+                [(run_id, pos, kind, payload, now) for pos, (kind, payload) in enumerate(items)],
+            )
+
+
+def journal_open_items(run_id=None, reset_in_flight=True):
+    """Ítems abiertos en orden; con `reset_in_flight=False` no escribe nada (--dry-run)."""
+    run_id = run_id or RUN_ID
+    with _db_lock:
+        db = get_db()
+        if reset_in_flight:
+            with db:
+                db.execute(
+                    "UPDATE jobs SET estado = 'pendiente' WHERE corrida = ? AND estado = 'en_curso'",
+                    (run_id,),
+                )
+        rows = db.execute(
+            f"SELECT tipo, valor FROM jobs WHERE corrida = ? AND {_OPEN_SQL} ORDER BY pos",
+            (run_id, JOURNAL_MAX_ATTEMPTS),
+        ).fetchall()
+    return [(kind, payload) for kind, payload in rows]
+
+
+def journal_begin(kind, payload):
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute(
+                "UPDATE jobs SET estado = 'en_curso', intentos = intentos + 1, actualizado = ? "
+                "WHERE corrida = ? AND tipo = ? AND valor = ?",
+                (time.time(), RUN_ID, kind, payload),
+            )
+
+
+def journal_finish(kind, payload, row):
+    estado = "fallido" if str(row.get("STATUS", "")).startswith("Error:") else "hecho"
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute(
+                "UPDATE jobs SET estado = ?, fila = ?, actualizado = ? "
+                "WHERE corrida = ? AND tipo = ? AND valor = ?",
+                (estado, json.dumps(row, ensure_ascii=False), time.time(), RUN_ID, kind, payload),
+            )
+
+
+def journal_final_rows(run_id=None):
+    with _db_lock:
+        rows = get_db().execute(
+            f"SELECT fila FROM jobs WHERE corrida = ? AND {_FINAL_SQL} AND fila IS NOT NULL ORDER BY pos",
+            (run_id or RUN_ID, JOURNAL_MAX_ATTEMPTS),
+        ).fetchall()
+    for (fila,) in rows:
+        yield json.loads(fila)
+
+
+def load_items(loop_index: int):
+    """
+    Ítems a procesar en este arranque. Si la corrida ya tiene journal se
+    continúa desde ahí; si no, se siembra con los códigos del loop y las URLs.
+    """
+    counts = journal_counts()
+    if counts:
+        items = journal_open_items()
+        resumen = ", ".join(f"{n} {estado}" for estado, n in sorted(counts.items()))
+        print(f"🗂️ Reanudando corrida '{RUN_ID}' desde el journal ({resumen}): {len(items)} ítems abiertos.")
+        return items
+
+    codes = load_codes_for_loop(loop_index)
+    urls = input_urls()
+    items = [("code", c) for c in codes] + [("url", u) for u in urls]
+    if SHARD is not None:
+        items = [(kind, payload) for (kind, payload) in items if in_shard(payload)]
+        print(f"🧩 Shard {SHARD[0]}/{SHARD[1]}: {len(items)} ítems de {len(codes) + len(urls)}.")
+    if PRIORITY_ENABLED and items:
+        # El orden queda fijado en el journal (pos), así que un arranque
+        # posterior sigue exactamente la misma prioridad.
+        items = prioritize_items(items)
+    journal_seed(items)
+    print(f"🗂️ Corrida '{RUN_ID}': journal creado con {len(items)} ítems.")
+    return items
+
+
+def planned_items(loop_index: int):
+    """
+    Lo que load_items procesaría en este arranque (códigos y URLs, sin lo
+    ya terminado en el journal), sin sembrar ni tocar el journal.
+    """
+    counts = journal_counts()
+    if counts:
+        items = journal_open_items(reset_in_flight=False)
+        print(f"🗂️ La corrida '{RUN_ID}' ya tiene journal: {len(items)} de {sum(counts.values())} ítems abiertos.")
+        return items
+    items = [("code", c) for c in load_codes_for_loop(loop_index)] + [("url", u) for u in input_urls()]
+    return [(kind, payload) for (kind, payload) in items if in_shard(payload)]
+
+
+# ================= Historial y reporte de cambios =======================
+# Cada fila emitida se agrega al historial (append-only, indexado por SKU y
+# fecha). Al final de la corrida se compara la última fila de cada SKU con
+# la última de corridas anteriores y sólo se reporta lo que cambió.
+DELTA_COLUMNS = ["SKU", "TIPO_CAMBIO", "VALOR_ANTERIOR", "VALOR_ACTUAL", "VARIACION_PCT",
+                 "FECHA_ANTERIOR", "TITULO", "URL_PRODUCTO"]
+
+
+def row_key(row):
+    return row.get("SKU") or row.get("URL_BUSQUEDA", "")
+
+
+def _num_or_none(value, cast=float):
+    if value is None or value == "":
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_ok(status):
+    return str(status or "").startswith("OK")
+
+
+def _is_failure(status):
+    return str(status or "").startswith(("HTTP error", "Error:"))
+
+
+def history_append(row, run_id=None):
+    now = time.time()
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute(
+                "INSERT INTO historial (sku, ts, fecha, corrida, url, titulo, precio_num, stock_num, "
+                "stock_texto, status, precio_texto) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    row_key(row), now, datetime.fromtimestamp(now).strftime("%Y-%m-%d"),
+                    run_id or RUN_ID, row.get("URL_PRODUCTO", ""), row.get("TITULO", ""),
+                    _num_or_none(row.get("PRECIO_NUM")), _num_or_none(row.get("STOCK_NUM"), int),
+                    row.get("STOCK_TEXTO", ""), row.get("STATUS", ""), row.get("PRECIO_TEXTO", ""),
+                ),
+            )
+
+
+HISTORY_ROW_COLUMNS = ("sku", "ts", "url", "titulo", "precio_num", "precio_texto", "stock_num",
+                       "stock_texto", "status")
+
+
+def history_row(obs):
+    """
+    Fila del CSV a partir de una observación del historial (dict con
+    HISTORY_ROW_COLUMNS). El texto del precio es el que dio el extractor;
+    en observaciones anteriores a la columna precio_texto se arma con el
+    formato del sitio ("$1,299.00"). La URL de búsqueda se reconstruye.
+    """
+    key, price, price_text = obs["sku"], obs["precio_num"], obs.get("precio_texto")
+    if not price_text and price is not None:
+        price_text = f"${price:,.2f}"
+    is_url = key.startswith(("http://", "https://"))
+    return {
+        "TIMESTAMP": datetime.fromtimestamp(obs["ts"]).strftime("%Y-%m-%d %H:%M:%S"),
+        "SKU": "" if is_url else key,
+        "URL_BUSQUEDA": key if is_url else BASE_SEARCH + quote_plus(key),
+        "URL_PRODUCTO": obs["url"] or "",
+        "TITULO": obs["titulo"] or "",
+        "PRECIO_TEXTO": price_text or "",
+        "PRECIO_NUM": price if price is not None else "",
+        "STOCK_TEXTO": obs["stock_texto"] or "",
+        "STOCK_NUM": obs["stock_num"] if obs["stock_num"] is not None else "",
+        "STATUS": obs["status"] or "",
+    }
+
+
+def run_history_rows(run_id):
+    """
+    Filas de una corrida armadas desde el historial, una por ítem: la última
+    observación sana si la hubo, si no la última. En el orden de la primera
+    visita.
+    """
+    rows = {}
+    with _db_lock:
+        cur = get_db().execute(
+            f"SELECT {', '.join(HISTORY_ROW_COLUMNS)} FROM historial WHERE corrida = ? ORDER BY id",
+            (run_id,),
+        )
+        for values in cur:
+            obs = dict(zip(HISTORY_ROW_COLUMNS, values))
+            prev = rows.get(obs["sku"])
+            if prev is None or not _is_failure(obs["status"]) or _is_failure(prev["status"]):
+                rows[obs["sku"]] = obs
+    return [history_row(obs) for obs in rows.values()]
+
+
+def compute_deltas(run_id=None):
+    """Cambios de la corrida contra la última observación previa de cada SKU."""
+    run_id = run_id or RUN_ID
+    with _db_lock:
+        db = get_db()
+        current = db.execute(
+            "SELECT h.sku, h.ts, h.url, h.titulo, h.precio_num, h.stock_num, h.status "
+            "FROM historial h JOIN (SELECT MAX(id) AS id FROM historial WHERE corrida = ? GROUP BY sku) u "
+            "ON h.id = u.id ORDER BY h.id",
+            (run_id,),
+        ).fetchall()
+        deltas = []
+        for sku, ts, url, titulo, precio, stock, status in current:
+            prev = db.execute(
+                "SELECT fecha, precio_num, stock_num, status FROM historial "
+                "WHERE sku = ? AND ts < ? AND corrida != ? ORDER BY ts DESC LIMIT 1",
+                (sku, ts, run_id),
+            ).fetchone()
+            if prev is None:
+                continue
+            p_fecha, p_precio, p_stock, p_status = prev
+            base = {"SKU": sku, "FECHA_ANTERIOR": p_fecha, "TITULO": titulo, "URL_PRODUCTO": url}
+            if _is_ok(p_status) and not _is_ok(status):
+                deltas.append({**base, "TIPO_CAMBIO": "nuevo_fallo",
+                               "VALOR_ANTERIOR": p_status, "VALOR_ACTUAL": status, "VARIACION_PCT": ""})
+            if precio is not None and p_precio is not None and abs(precio - p_precio) > 0.005:
+                pct = (precio - p_precio) / p_precio * 100.0 if p_precio else ""
+                deltas.append({**base, "TIPO_CAMBIO": "precio", "VALOR_ANTERIOR": p_precio,
+                               "VALOR_ACTUAL": precio, "VARIACION_PCT": round(pct, 2) if pct != "" else ""})
+            if stock is not None and p_stock is not None and (stock == 0) != (p_stock == 0):
+                deltas.append({**base, "TIPO_CAMBIO": "agotado" if stock == 0 else "reabasto",
+                               "VALOR_ANTERIOR": p_stock, "VALOR_ACTUAL": stock, "VARIACION_PCT": ""})
+    return deltas
+
+
+def write_delta_report(path, run_id=None):
+    deltas = compute_deltas(run_id)
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=DELTA_COLUMNS)
+        writer.writeheader()
+        writer.writerows(deltas)
+    counts = {}
+    for d in deltas:
+        counts[d["TIPO_CAMBIO"]] = counts.get(d["TIPO_CAMBIO"], 0) + 1
+    return counts
+
+
+# ================= Alertas de precio / stock ============================
+# Reglas declaradas en un JSON (CYBERPUERTA_ALERTAS, por defecto
+# cyberpuerta_alertas.json si existe) que se evalúan con cada fila en
+# cuanto se emite, no al final de la corrida:
+#
+#   [{"sku": "SNV3S/1000G", "tipo": "precio_menor", "umbral": 1200},
+#    {"prefijo": "KF", "tipo": "caida_pct", "umbral": 15, "nombre": "RAM Kingston Fury"},
+#    {"prefijo": "", "tipo": "reabastecido"}]
+#
+# "sku" es exacto y "prefijo" aplica a todos los SKUs que empiezan así (el
+# prefijo de marca del número de parte; "" = todos). Las reglas se indexan
+# por SKU y por prefijo, así que una fila sólo revisa las que le aplican.
+# Las alertas son por flanco: se disparan cuando la condición pasa de
+# falsa a verdadera respecto a la observación OK anterior del historial,
+# no en cada corrida mientras siga vigente.
+ALERT_RULES_PATH = os.environ.get("CYBERPUERTA_ALERTAS", "cyberpuerta_alertas.json")
+ALERT_WEBHOOK = os.environ.get("CYBERPUERTA_ALERTAS_WEBHOOK", "")
+ALERT_TYPES = ("precio_menor", "caida_pct", "reabastecido")
+ALERT_MEDIAN_OBS = 10         # observaciones OK para la mediana móvil
+ALERT_MEDIAN_DAYS = 30
+ALERT_COLUMNS = ["TIMESTAMP", "SKU", "REGLA", "TIPO", "MENSAJE", "PRECIO_NUM", "STOCK_NUM", "URL_PRODUCTO"]
+
+
+def load_alert_rules(path):
+    with open(path, encoding="utf-8") as f:
+        rules = json.load(f)
+    if not isinstance(rules, list):
+        raise ValueError(f"{path}: se esperaba una lista de reglas")
+    for i, rule in enumerate(rules):
+        if rule.get("tipo") not in ALERT_TYPES:
+            raise ValueError(f"{path}: regla {i}: tipo debe ser uno de {', '.join(ALERT_TYPES)}")
+        if ("sku" in rule) == ("prefijo" in rule):
+            raise ValueError(f"{path}: regla {i}: lleva 'sku' o 'prefijo' (uno de los dos)")
+        if rule["tipo"] != "reabastecido" and not isinstance(rule.get("umbral"), (int, float)):
+            raise ValueError(f"{path}: regla {i}: falta 'umbral' numérico")
+        rule.setdefault("nombre", f"regla {i}")
+    return rules
+
+
+class AlertNotifier:
+    """
+    Entrega las alertas en un hilo aparte (webhook y/o correo) para no
+    frenar el scraping. `close()` espera a que salga lo pendiente.
+    """
+
+    def __init__(self, csv_path):
+        import queue
+        self.csv_path = csv_path
+        self.queue = queue.Queue()
+        self.thread = None
+        # Con varios workers: una fila del CSV a la vez y un solo hilo de entrega
+        self.lock = threading.Lock()
+
+    def send(self, alert):
+        with self.lock:
+            fresh = not (os.path.isfile(self.csv_path) and os.path.getsize(self.csv_path) > 0)
+            with open(self.csv_path, "a", encoding="utf-8-sig" if fresh else "utf-8", newline="") as f:
+                w = csv.DictWriter(f, fieldnames=ALERT_COLUMNS)
+                if fresh:
+                    w.writeheader()
+                w.writerow(alert)
+        with _print_lock:
+            print(f"🔔 {alert['MENSAJE']}")
+        if not (ALERT_WEBHOOK or os.environ.get("EMAIL_SENDER")):
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._deliver, daemon=True)
+                self.thread.start()
+            self.queue.put(alert)
+
+    def _deliver(self):
+        while True:
+            alert = self.queue.get()
+            if alert is None:
+                return
+            try:
+                if ALERT_WEBHOOK:
+                    import requests
+                    # "text" lo entienden Slack, Mattermost y Google Chat; el resto va aparte
+                    requests.post(ALERT_WEBHOOK, json={"text": alert["MENSAJE"], "alerta": alert}, timeout=15)
+                sender = os.environ.get("EMAIL_SENDER")
+                password = os.environ.get("EMAIL_PASSWORD")
+                recipient = os.environ.get("EMAIL_TO")
+                if sender and password and recipient:
+                    enviar_alerta_por_mail(sender, password, recipient, alert)
+            except Exception as e:
+                print(f"⚠️ No se pudo entregar la alerta ({alert['REGLA']} / {alert['SKU']}): {e}")
+
+    def close(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is not None:
+                self.queue.put(None)
+        if thread is not None:
+            thread.join(timeout=120)
+
+
+class AlertEngine:
+    """Reglas indexadas por SKU exacto y por prefijo; `evaluate(row)` por cada fila emitida."""
+
+    def __init__(self, rules, notifier):
+        self.by_sku = {}
+        self.by_prefix = {}
+        self.prefix_lengths = set()
+        for rule in rules:
+            if "sku" in rule:
+                self.by_sku.setdefault(norm_sku(rule["sku"]), []).append(rule)
+            else:
+                prefix = norm_sku(rule["prefijo"])
+                self.by_prefix.setdefault(prefix, []).append(rule)
+                self.prefix_lengths.add(len(prefix))
+        self.n_rules = len(rules)
+        self.notifier = notifier
+        self.fired = 0
+
+    def rules_for(self, key):
+        k = norm_sku(key)
+        found = list(self.by_sku.get(k, ()))
+        for n in self.prefix_lengths:
+            if n <= len(k):
+                found.extend(self.by_prefix.get(k[:n], ()))
+        return found
+
+    def evaluate(self, row):
+        if not _is_ok(row.get("STATUS")):
+            return []
+        key = row_key(row)
+        rules = self.rules_for(key)
+        if not rules:
+            return []
+        price = _num_or_none(row.get("PRECIO_NUM"))
+        stock = _num_or_none(row.get("STOCK_NUM"), int)
+        with _db_lock:
+            prev = get_db().execute(
+                "SELECT precio_num, stock_num FROM historial WHERE sku = ? AND status LIKE 'OK%' "
+                "ORDER BY ts DESC LIMIT 1",
+                (key,),
+            ).fetchone()
+        prev_price, prev_stock = prev if prev else (None, None)
+        median = None
+        fired = []
+        for rule in rules:
+            kind, limit = rule["tipo"], rule.get("umbral")
+            msg = None
+            if kind == "precio_menor":
+                if price is not None and price < limit and not (prev_price is not None and prev_price < limit):
+                    msg = f"precio ${price:,.2f} bajo ${limit:,.2f}"
+            elif kind == "caida_pct":
+                if median is None:
+                    median = self._rolling_median(key)
+                if price is not None and median:
+                    target = median * (1.0 - limit / 100.0)
+                    if price <= target and not (prev_price is not None and prev_price <= target):
+                        msg = f"precio ${price:,.2f}, {1.0 - price / median:.1%} bajo la mediana ${median:,.2f}"
+            elif kind == "reabastecido":
+                if prev_stock == 0 and stock is not None and stock > 0:
+                    msg = f"volvió a tener stock ({stock} disponibles)"
+            if msg is None:
+                continue
+            alert = {
+                "TIMESTAMP": row.get("TIMESTAMP", ""), "SKU": key, "REGLA": rule["nombre"], "TIPO": kind,
+                "MENSAJE": f"{key} ({row.get('TITULO', '')[:60]}): {msg} [{rule['nombre']}]",
+                "PRECIO_NUM": row.get("PRECIO_NUM", ""), "STOCK_NUM": row.get("STOCK_NUM", ""),
+                "URL_PRODUCTO": row.get("URL_PRODUCTO", ""),
+            }
+            self.notifier.send(alert)
+            fired.append(alert)
+        self.fired += len(fired)
+        return fired
+
+    @staticmethod
+    def _rolling_median(key):
+        with _db_lock:
+            prices = [p for (p,) in get_db().execute(
+                "SELECT precio_num FROM historial WHERE sku = ? AND ts >= ? AND status LIKE 'OK%' "
+                "AND precio_num IS NOT NULL ORDER BY ts DESC LIMIT ?",
+                (key, time.time() - ALERT_MEDIAN_DAYS * 86400.0, ALERT_MEDIAN_OBS),
+            )]
+        return statistics.median(prices) if prices else None
+
+
+# Se carga en el primer emit_row(); False = sin reglas
+alert_engine = None
+_alert_lock = threading.Lock()
+
+
+def get_alert_engine():
+    global alert_engine
+    with _alert_lock:
+        if alert_engine is None:
+            alert_engine = False
+            if ALERT_RULES_PATH and os.path.isfile(ALERT_RULES_PATH):
+                rules = load_alert_rules(ALERT_RULES_PATH)
+                notifier = AlertNotifier(f"cyberpuerta_alertas{output_suffix()}.csv")
+                alert_engine = AlertEngine(rules, notifier)
+                print(f"🔔 {len(rules)} reglas de alerta cargadas de '{ALERT_RULES_PATH}'.")
+        return alert_engine
+
+
+def close_alerts():
+    """Espera a que salgan las alertas pendientes; la siguiente corrida recarga las reglas."""
+    global alert_engine
+    with _alert_lock:
+        if alert_engine:
+            alert_engine.notifier.close()
+            if alert_engine.fired:
+                print(f"🔔 {alert_engine.fired} alertas disparadas (ver '{alert_engine.notifier.csv_path}').")
+        alert_engine = None
+
+
+# ================= Frescura y caché negativo ============================
+# Antes de la pasada, con el historial:
+# - un SKU con observación OK más reciente que FRESH_TTL_HOURS no se visita
+#   (0 = siempre se visita, el comportamiento de siempre);
+# - con CYBERPUERTA_CACHE_NEGATIVO=1, un SKU que viene dando "Sin
+#   resultados" / "404 búsqueda" se revisa cada vez más espaciado:
+#   NEGATIVE_BASE_DAYS tras la primera vez, doblando con cada confirmación
+#   hasta NEGATIVE_MAX_DAYS.
+# Los dos vienen apagados: sin configurarlos se visita todo, como siempre.
+# Los dos escriben su última fila conocida (con el TIMESTAMP de cuando se
+# observó y el motivo en STATUS) para que el CSV siga completo, pero no
+# tocan el historial: la siguiente revisión se cuenta desde la última
+# visita real.
+FRESH_TTL_HOURS = float(os.environ.get("CYBERPUERTA_FRESCURA_HORAS", "0"))
+NEGATIVE_CACHE_ENABLED = os.environ.get("CYBERPUERTA_CACHE_NEGATIVO", "0") == "1"
+NEGATIVE_BASE_DAYS = 1.0
+NEGATIVE_MAX_DAYS = 30.0
+NEGATIVE_SLACK = 0.9          # una corrida diaria que arranca minutos antes no se salta un día
+NOT_FOUND_STATUSES = ("Sin resultados", "404 búsqueda")
+
+
+def _is_not_found(status):
+    return str(status or "").startswith(NOT_FOUND_STATUSES)
+
+
+def negative_recheck_seconds(misses):
+    return min(NEGATIVE_BASE_DAYS * 2 ** max(misses - 1, 0), NEGATIVE_MAX_DAYS) * 86400.0
+
+
+def freshness_state(keys):
+    """
+    Por clave: (última observación como dict, última OK como dict, cuántas
+    "no encontrado" seguidas hay al final). Las fallas de red no cuentan
+    ni para un lado ni para el otro.
+    """
+    cols = ("ts", "url", "titulo", "precio_num", "precio_texto", "stock_num", "stock_texto", "status")
+    state = {key: [None, None, 0, False] for key in keys}
+    horizon = time.time() - 4 * NEGATIVE_MAX_DAYS * 86400.0
+    with _db_lock:
+        cur = get_db().execute(
+            f"SELECT sku, {', '.join(cols)} FROM historial WHERE ts >= ? ORDER BY sku, ts DESC",
+            (horizon,),
+        )
+        for sku, *values in cur:
+            st = state.get(sku)
+            if st is None or st[1] is not None:
+                continue
+            obs = dict(zip(cols, values))
+            if _is_failure(obs["status"]):
+                continue
+            if st[0] is None:
+                st[0] = obs
+            if _is_ok(obs["status"]):
+                st[1] = obs
+                st[3] = True
+            elif _is_not_found(obs["status"]) and not st[3]:
+                st[2] += 1
+    return {key: (last, last_ok, misses) for key, (last, last_ok, misses, _) in state.items()}
+
+
+def _cached_row(payload, obs, status):
+    return history_row(dict(obs, sku=payload, status=status))
+
+
+freshness_stats = {"frescos": 0, "negativos": 0, "peticiones_ahorradas": 0, "segundos_ahorrados": 0.0}
+
+
+def skip_known_items(items):
+    """
+    Separa los ítems que no hace falta visitar. Devuelve (por_visitar,
+    [(tipo, valor, fila)]) y acumula en freshness_stats lo que se ahorra.
+    """
+    if not items or not (FRESH_TTL_HOURS > 0 or NEGATIVE_CACHE_ENABLED):
+        return items, []
+    now = time.time()
+    state = freshness_state([payload for _, payload in items])
+    per_item = item_duration_model()["media"]
+    keep, skipped = [], []
+    for kind, payload in items:
+        last, last_ok, misses = state[payload]
+        if FRESH_TTL_HOURS > 0 and last_ok is not None and last is last_ok \
+                and now - last_ok["ts"] < FRESH_TTL_HOURS * 3600.0:
+            hours = (now - last_ok["ts"]) / 3600.0
+            row = _cached_row(payload, last_ok, f"OK (fresco, visto hace {hours:.1f} h)")
+            freshness_stats["frescos"] += 1
+            # Con la URL en caché se ahorra sólo el detalle; si no, búsqueda + detalle
+            freshness_stats["peticiones_ahorradas"] += 1 if kind == "code" and url_cache_peek(payload) else 2
+        elif NEGATIVE_CACHE_ENABLED and misses and last is not None \
+                and now - last["ts"] < NEGATIVE_SLACK * negative_recheck_seconds(misses):
+            due = datetime.fromtimestamp(last["ts"] + negative_recheck_seconds(misses)).strftime("%Y-%m-%d")
+            row = _cached_row(payload, last, f"{last['status']} (caché negativo, {misses}x; se revisa el {due})")
+            freshness_stats["negativos"] += 1
+            freshness_stats["peticiones_ahorradas"] += 1
+        else:
+            keep.append((kind, payload))
+            continue
+        freshness_stats["segundos_ahorrados"] += per_item
+        skipped.append((kind, payload, row))
+    if skipped:
+        print(
+            f"🧊 {freshness_stats['frescos']} ítems frescos y {freshness_stats['negativos']} en caché negativo "
+            f"no se visitan: ~{freshness_stats['peticiones_ahorradas']} peticiones y "
+            f"~{freshness_stats['segundos_ahorrados'] / 3600:.2f} h ahorradas."
+        )
+    return keep, skipped
+
+
+# ================= Prioridad por volatilidad =============================
+def priority_scores(keys):
+    """
+    Puntaje por SKU: qué tan seguido cambió precio/stock entre observaciones
+    consecutivas, días desde el último OK (tope 7) y proporción de fallos.
+    Un SKU sin historial recibe el máximo: no sabemos nada de él.
+    """
+    now = time.time()
+    obs = {key: [] for key in keys}
+    with _db_lock:
+        cur = get_db().execute(
+            "SELECT sku, ts, precio_num, stock_num, status FROM historial "
+            "WHERE ts >= ? ORDER BY sku, ts DESC",
+            (now - PRIORITY_WINDOW_DAYS * 86400.0,),
+        )
+        for sku, ts, precio, stock, status in cur:
+            lst = obs.get(sku)
+            if lst is not None and len(lst) < PRIORITY_MAX_OBS:
+                lst.append((ts, precio, stock, _is_ok(status)))
+
+    w = PRIORITY_WEIGHTS
+    scores = {}
+    for key, lst in obs.items():
+        if not lst:
+            scores[key] = float("inf")
+            continue
+        ok = [o for o in lst if o[3]]
+        pairs = list(zip(ok, ok[1:]))
+        changes = sum(1 for a, b in pairs if a[1] != b[1] or a[2] != b[2])
+        change_rate = changes / len(pairs) if pairs else 0.5
+        fail_rate = (len(lst) - len(ok)) / len(lst)
+        stale_days = (now - ok[0][0]) / 86400.0 if ok else 7.0
+        scores[key] = (w["cambio"] * change_rate
+                       + w["antiguedad"] * min(stale_days, 7.0) / 7.0
+                       + w["fallos"] * fail_rate)
+    return scores
+
+
+def prioritize_items(items):
+    scores = priority_scores([payload for _, payload in items])
+    ordered = sorted(items, key=lambda it: -scores.get(it[1], 0.0))
+    top = ", ".join(
+        f"{payload} ({'nuevo' if scores[payload] == float('inf') else format(scores[payload], '.2f')})"
+        for _, payload in ordered[:5]
+    )
+    print(f"🎯 Orden por prioridad (volatilidad/antigüedad/fallos). Primeros: {top}")
+    return ordered
+
+
+# ================= Planificador del presupuesto de tiempo ===============
+PLANNER_SAMPLE = 500          # duraciones recientes que usa el planificador
+PLANNER_FETCH_SECONDS = 2.0   # estimación por petición cuando no hay historial
+
+
+def record_duration(key, stages, total, status):
+    with _db_lock:
+        db = get_db()
+        with db:
+            db.execute(
+                "INSERT INTO duraciones (ts, corrida, sku, espera, red, backoff, parseo, total, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), RUN_ID, key, stages["espera"], stages["red"], stages["backoff"],
+                 stages["parseo"], total, status),
+            )
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    idx = min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))
+    return values[idx]
+
+
+def item_duration_model(workers=None):
+    """
+    Duración esperada por ítem (media y p90, en segundos) a partir de las
+    duraciones registradas; sin historial se estima con los parámetros de
+    espera. En modo concurrente se divide entre los workers, sin bajar del
+    ritmo que permite el control de tasa (2 peticiones por ítem).
+    """
+    workers = WORKERS if workers is None else workers
+    with _db_lock:
+        rows = get_db().execute(
+            "SELECT espera, red, backoff, parseo, total FROM duraciones ORDER BY id DESC LIMIT ?",
+            (PLANNER_SAMPLE,),
+        ).fetchall()
+    if rows:
+        totals = [r[4] for r in rows]
+        mean = statistics.fmean(totals)
+        p90 = _percentile(totals, 0.9)
+        stages = {name: statistics.fmean(r[i] for r in rows) for i, name in enumerate(STAGES)}
+        source = f"{len(rows)} ítems medidos"
+    else:
+        slowdown = get_rate_controller().slowdown()
+        espera = statistics.fmean(INITIAL_WAIT_RANGE) * slowdown + statistics.fmean(BETWEEN_REQUESTS)
+        stages = {"espera": espera, "red": 2 * PLANNER_FETCH_SECONDS, "backoff": 0.0, "parseo": 0.1}
+        mean = sum(stages.values())
+        p90 = INITIAL_WAIT_RANGE[1] * slowdown + BETWEEN_REQUESTS[1] + 4 * PLANNER_FETCH_SECONDS
+        source = "parámetros de espera (sin historial)"
+    if workers > 1:
+        floor = 2 * 60.0 / get_rate_controller().rate
+        mean = max(mean / workers, floor)
+    return {"media": mean, "p90": p90, "etapas": stages, "fuente": source}
+
+
+def plan_run(n_items, max_hours=None, guard_minutes=None, workers=None):
+    max_hours = MAX_TOTAL_HOURS if max_hours is None else max_hours
+    guard_minutes = TIME_GUARD_MINUTES if guard_minutes is None else guard_minutes
+    model = item_duration_model(workers)
+    est_seconds = n_items * model["media"]
+    plan = {"items": n_items, "modelo": model, "horas_estimadas": est_seconds / 3600.0}
+    if max_hours > 0:
+        budget = max(0.0, max_hours * 3600.0 - guard_minutes * 60.0 - model["p90"])
+        per_loop = int(budget // model["media"]) if model["media"] > 0 else n_items
+        plan["por_loop"] = per_loop
+        plan["loops"] = math.ceil(n_items / per_loop) if per_loop else None
+        plan["reparto"] = [min(per_loop, n_items - k * per_loop) for k in range(plan["loops"] or 0)]
+    return plan
+
+
+def print_plan(plan):
+    m = plan["modelo"]
+    etapas = ", ".join(f"{k} {v:.1f}s" for k, v in m["etapas"].items())
+    print(f"🧮 Plan: {plan['items']} ítems x {m['media']:.1f}s (p90 {m['p90']:.1f}s; {m['fuente']}).")
+    print(f"   Etapas medias: {etapas}.")
+    print(f"   Duración estimada: {plan['horas_estimadas']:.2f} h.")
+    if "por_loop" in plan:
+        if plan["loops"] is None:
+            print("   ⚠️ Con este presupuesto no cabe ni un ítem por loop.")
+        else:
+            reparto = ", ".join(f"loop {k + 1}: {n}" for k, n in enumerate(plan["reparto"]))
+            print(f"   Caben ~{plan['por_loop']} ítems por loop -> {plan['loops']} loop(s) ({reparto}).")
 
 
 def process_code(code):
@@ -477,49 +3137,79 @@ def process_code(code):
     s_txt = ""
     s_num = ""
 
-    saw_429 = [False]
+    search_harvest.done(sku)
+    cached = url_cache_get(sku)
 
-    initial_wait = planned_initial_wait()
-    print(f"   ⏳ Espera inicial antes de buscar '{sku}': {initial_wait:.1f}s (ratio 429 reciente: {current_429_ratio():.2f})")
-    time.sleep(initial_wait)
+    # Si otra variante ya trajo en esta corrida la página que tenemos en
+    # caché, este SKU no necesita ninguna petición: tampoco la espera.
+    paced = not (cached and product_pages.has_fields(cached[0]))
+    if paced:
+        pause_initial(f"'{sku}'")
+    else:
+        product_pages.count("esperas_ahorradas")
 
-    r = get_with_backoff(url_search, mark_429_flag=saw_429)
-    if not r:
-        return {
-            "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": "",
-            "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "", "STOCK_TEXTO": "",
-            "STOCK_NUM": "", "STATUS": "HTTP error búsqueda"
-        }
-    if r.status_code == 404:
-        return {
-            "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": "",
-            "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "", "STOCK_TEXTO": "",
-            "STOCK_NUM": "", "STATUS": "404 búsqueda"
-        }
+    # Si ya conocemos la URL del producto, vamos directo al detalle y
+    # nos ahorramos la búsqueda. Si la página ya no existe o cambió de
+    # producto, invalidamos y caemos a la búsqueda normal.
+    found = False
+    if cached:
+        cached_url, cached_title = cached
+        cached_status, extracted = fetch_product(cached_url, sku)
+        if extracted is not None:
+            # Sin título guardado (URL de un listado o de otra búsqueda) la
+            # primera lectura del detalle es la referencia.
+            if not cached_title or _norm_title(extracted[0]) == _norm_title(cached_title):
+                url_prod, found = cached_url, True
+                title, p_txt, p_num, s_txt, s_num = extracted
+                if not cached_title:
+                    url_cache_put(sku, cached_url, title)
+            else:
+                print(f"   ♻️ URL en caché para '{sku}' cambió de título, se vuelve a buscar.")
+                url_cache_invalidate(sku)
+        elif cached_status == 404:
+            print(f"   ♻️ URL en caché para '{sku}' regresó 404, se vuelve a buscar.")
+            url_cache_invalidate(sku)
+        if not found:
+            _slept = pause_between() if paced else pause_initial(f"'{sku}'")
 
-    _slept = sleep_range(*BETWEEN_REQUESTS)
-    first = parse_first_product_url_from_search(r.text, r.url)
-    if not first:
-        return {
-            "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": "",
-            "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "", "STOCK_TEXTO": "",
-            "STOCK_NUM": "", "STATUS": "Sin resultados"
-        }
+    if not found:
+        r = get_with_backoff(url_search, kind="busqueda")
+        if not r:
+            return {
+                "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": "",
+                "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "", "STOCK_TEXTO": "",
+                "STOCK_NUM": "", "STATUS": "HTTP error búsqueda"
+            }
+        if r.status_code == 404:
+            return {
+                "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": "",
+                "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "", "STOCK_TEXTO": "",
+                "STOCK_NUM": "", "STATUS": "404 búsqueda"
+            }
 
-    url_prod = first
-    r2 = get_with_backoff(url_prod, mark_429_flag=saw_429)
-    if not r2 or r2.status_code == 404:
-        return {
-            "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": url_prod,
-            "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "", "STOCK_TEXTO": "",
-            "STOCK_NUM": "", "STATUS": f"HTTP error detalle ({None if not r2 else r2.status_code})"
-        }
+        archive_page(sku, "busqueda", r)
+        _slept = pause_between()
+        with stage("parseo", tier="busqueda"):
+            first = parse_first_product_url_from_search(r.text, r.url)
+        if not first:
+            return {
+                "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": "",
+                "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "", "STOCK_TEXTO": "",
+                "STOCK_NUM": "", "STATUS": "Sin resultados"
+            }
+        search_harvest.harvest(r.text, r.url, sku)
 
-    title, p_txt, p_num, s_txt, s_num = extract_all_from_product(r2.text)
+        url_prod = first
+        detail_status, extracted = fetch_product(url_prod, sku)
+        if extracted is None:
+            return {
+                "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": url_prod,
+                "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "", "STOCK_TEXTO": "",
+                "STOCK_NUM": "", "STATUS": f"HTTP error detalle ({detail_status})"
+            }
 
-    recent_429.append(bool(saw_429[0]))
-    if len(recent_429) > ROLLING_WINDOW:
-        recent_429.pop(0)
+        title, p_txt, p_num, s_txt, s_num = extracted
+        url_cache_put(sku, url_prod, title)
 
     return {
         "TIMESTAMP": ts,
@@ -546,13 +3236,11 @@ def process_url(url):
     p_num = ""
     s_txt = ""
     s_num = ""
-    saw_429 = [False]
 
-    initial_wait = planned_initial_wait()
-    print(f"   ⏳ Espera inicial antes de buscar URL: {initial_wait:.1f}s (ratio 429 reciente: {current_429_ratio():.2f})")
-    time.sleep(initial_wait)
+    pause_initial("URL")
 
-    r = get_with_backoff(url_search, mark_429_flag=saw_429)
+    is_search = "searchparam=" in url_search
+    r = get_with_backoff(url_search, conditional=not is_search, kind="busqueda" if is_search else "detalle")
     if not r:
         return {
             "TIMESTAMP": ts, "SKU": sku, "URL_BUSQUEDA": url_search, "URL_PRODUCTO": "",
@@ -560,25 +3248,27 @@ def process_url(url):
             "STOCK_NUM": "", "STATUS": "HTTP error URL"
         }
 
-    if "searchparam=" in url_search:
-        _slept = sleep_range(*BETWEEN_REQUESTS)
-        first = parse_first_product_url_from_search(r.text, r.url)
+    if is_search:
+        archive_page(url, "busqueda", r)
+        _slept = pause_between()
+        with stage("parseo", tier="busqueda"):
+            first = parse_first_product_url_from_search(r.text, r.url)
         if first:
             url_prod = first
-            r2 = get_with_backoff(url_prod, mark_429_flag=saw_429)
-            if r2 and r2.status_code != 404:
-                title, p_txt, p_num, s_txt, s_num = extract_all_from_product(r2.text)
+            detail_status, extracted = fetch_product(url_prod, url)
+            if extracted is not None:
+                title, p_txt, p_num, s_txt, s_num = extracted
             else:
-                status = f"HTTP error detalle ({None if not r2 else r2.status_code})"
+                status = f"HTTP error detalle ({detail_status})"
         else:
             status = "Sin resultados"
     else:
         url_prod = r.url
-        title, p_txt, p_num, s_txt, s_num = extract_all_from_product(r.text)
-
-    recent_429.append(bool(saw_429[0]))
-    if len(recent_429) > ROLLING_WINDOW:
-        recent_429.pop(0)
+        extracted = product_fields(url_search, r, url)
+        if extracted is not None:
+            title, p_txt, p_num, s_txt, s_num = extracted
+        else:
+            status = f"HTTP error detalle ({r.status_code})"
 
     return {
         "TIMESTAMP": ts,
@@ -594,12 +3284,200 @@ def process_url(url):
     }
 
 
+def run_item(kind, payload):
+    journal_begin(kind, payload)
+    timing_reset()
+    t0 = time.monotonic()
+    row = _run_item(kind, payload)
+    stages, total = timing_snapshot(), time.monotonic() - t0
+    record_duration(payload, stages, total, row.get("STATUS"))
+    metrics.record_item(stages, total)
+    journal_finish(kind, payload, row)
+    return row
+
+
+def _run_item(kind, payload):
+    try:
+        if kind == "code":
+            return process_code(payload)
+        return process_url(payload)
+    except Exception as e:
+        return {
+            "TIMESTAMP": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "SKU": payload if kind == "code" else "",
+            "URL_BUSQUEDA": BASE_SEARCH + quote_plus(payload) if kind == "code" else payload,
+            "URL_PRODUCTO": "",
+            "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "",
+            "STOCK_TEXTO": "", "STOCK_NUM": "", "STATUS": f"Error: {e}"
+        }
+
+
+# ================= Reintentos diferidos =================================
+# Un ítem que termina en "HTTP error ..." (salvo un 404) o "Error: ..." no
+# se escribe todavía: entra a una cola y se reintenta al final de la
+# pasada, nunca antes de DEFERRED_COOLDOWN minutos desde su falla (la
+# pausa se dobla en cada intento), hasta DEFERRED_ATTEMPTS veces. Así una
+# ventana de bloqueo pasajera no deja huecos en el día sin otro loop ni
+# otro arranque. Lo que siga fallando, o ya no quepa antes del límite de
+# tiempo, se escribe con su último estado, como antes.
+DEFERRED_ATTEMPTS = int(os.environ.get("CYBERPUERTA_REINTENTOS_DIFERIDOS", "2"))
+DEFERRED_COOLDOWN = float(os.environ.get("CYBERPUERTA_ENFRIAMIENTO_MIN", "10"))
+
+
+def is_retryable_failure(status):
+    status = str(status or "")
+    return _is_failure(status) and not status.endswith("(404)")
+
+
+class DeferredRetryQueue:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.heap = []      # (listo_en, secuencia, tipo, valor, última fila, intentos)
+        self.seq = 0
+        self.counts = {"diferidos": 0, "recuperados": 0, "agotados": 0, "sin_tiempo": 0}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def offer(self, kind, payload, row, tries=0):
+        """True si el ítem queda en cola; False si su fila ya es la final."""
+        if tries >= DEFERRED_ATTEMPTS or not is_retryable_failure(row.get("STATUS")):
+            return False
+        if tries == 0:
+            self.counts["diferidos"] += 1
+        ready_at = time.time() + DEFERRED_COOLDOWN * 60.0 * 2 ** tries
+        self.seq += 1
+        heapq.heappush(self.heap, (ready_at, self.seq, kind, payload, row, tries))
+        return True
+
+    def drain(self, deadline=None):
+        """
+        Reintenta la cola hasta vaciarla o llegar a `deadline`; emite la fila
+        final de cada ítem. Devuelve cuántas filas emitió.
+        """
+        emitted = 0
+        if self.heap:
+            print(f"\n🔁 Reintentos diferidos: {len(self.heap)} ítems en cola.")
+        while self.heap:
+            ready_at, _, kind, payload, row, tries = heapq.heappop(self.heap)
+            if deadline is not None and max(ready_at, time.time()) >= deadline:
+                self.counts["sin_tiempo"] += 1
+                emit_row(row)
+                emitted += 1
+                continue
+            wait = ready_at - time.time()
+            if wait > 0:
+                print(f"   ⏳ Enfriamiento antes de reintentar {payload}: {wait:.0f}s")
+                sleep_until_fetch(wait, BASE_URL + "/")
+            new_row = run_item(kind, payload)
+            report_row(f"reintento {tries + 1}", DEFERRED_ATTEMPTS, payload, new_row)
+            if self.offer(kind, payload, new_row, tries + 1):
+                continue
+            self.counts["agotados" if is_retryable_failure(new_row.get("STATUS")) else "recuperados"] += 1
+            emit_row(new_row)
+            emitted += 1
+        c = self.counts
+        if c["diferidos"]:
+            print(
+                f"🔁 Reintentos diferidos: {c['recuperados']} recuperados, {c['agotados']} siguen fallando, "
+                f"{c['sin_tiempo']} sin tiempo (de {c['diferidos']} diferidos)."
+            )
+        return emitted
+
+
+deferred_retries = DeferredRetryQueue()
+
+
+def report_row(i, total, payload, row):
+    with _print_lock:
+        print(f"[{i}/{total}] {payload} -> {row['STATUS']}")
+        print(row_to_tsv(row))
+        sys.stdout.flush()
+
+
+def run_concurrent(items, deadline):
+    """
+    Procesa `items` con WORKERS hilos que comparten el token bucket global.
+    Las filas se emiten en el mismo orden que el modo serial (un pequeño
+    buffer retiene las que terminan antes que sus predecesoras).
+    Devuelve (filas_emitidas, pending_items).
+    """
+    global rate_limiter
+    total = len(items)
+    controller = get_rate_controller()
+    rate_limiter = TokenBucket(controller.rate, RATE_BURST, controller=controller)
+    print(f"⚡ Modo concurrente: {WORKERS} workers, arrancando a {controller.rate:.2f} pet/min (ráfaga {RATE_BURST:g}).")
+
+    def work(i, kind, payload):
+        if deadline is not None and time.time() >= deadline:
+            return None
+        row = run_item(kind, payload)
+        report_row(i, total, payload, row)
+        return row
+
+    done = {}
+    next_idx = 0
+    emitted = 0
+    pending_items = []
+    try:
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            futures = {
+                pool.submit(work, i, kind, payload): i - 1
+                for i, (kind, payload) in enumerate(items, 1)
+            }
+            for fut in as_completed(futures):
+                done[futures[fut]] = fut.result()
+                while next_idx in done:
+                    row = done.pop(next_idx)
+                    if row is None:
+                        pending_items.append(items[next_idx])
+                    elif not deferred_retries.offer(*items[next_idx], row):
+                        emit_row(row)
+                        emitted += 1
+                    next_idx += 1
+        # Con el mismo token bucket que la pasada
+        emitted += deferred_retries.drain(deadline)
+    finally:
+        rate_limiter = None
+
+    return emitted, pending_items
+
+
+def run_serial(items, deadline):
+    total = len(items)
+    emitted = 0
+    for i, (kind, payload) in enumerate(items, 1):
+        if deadline is not None and time.time() >= deadline:
+            print(
+                f"⏹️ Se alcanzó el límite de tiempo de {MAX_TOTAL_HOURS:.2f} horas.\n"
+                f"   Se detiene en el ítem {i}/{total}. Lo que falta se guardará como pendientes."
+            )
+            emitted += deferred_retries.drain(deadline)
+            return emitted, items[i-1:]
+
+        row = run_item(kind, payload)
+        report_row(i, total, payload, row)
+        if deferred_retries.offer(kind, payload, row):
+            continue
+        emit_row(row)
+        emitted += 1
+    emitted += deferred_retries.drain(deadline)
+    return emitted, []
+
+
 def main(loop_index: int = 1):
-    codes = load_codes_for_loop(loop_index)
-    urls = [u.strip() for u in INPUT_URLS if u.strip()]
-    items = [("code", c) for c in codes] + [("url", u) for u in urls]
+    global row_sink, run_deadline
+    items = load_items(loop_index)
+    product_pages.reset()
+    deferred_retries.reset()
+    for k in freshness_stats:
+        freshness_stats[k] = 0
+    items, known_rows = skip_known_items(items)
+    codes = [payload for (kind, payload) in items if kind == "code"]
+    search_harvest.reset(codes)
 
-    results = []
     total = len(items)
     print(f"👉 LOOP {loop_index} – Procesando {total} ítems…\n")
     print_header_once()
@@ -607,100 +3485,456 @@ def main(loop_index: int = 1):
     start_time = time.time()
     limit_seconds = MAX_TOTAL_HOURS * 3600.0 if MAX_TOTAL_HOURS > 0 else None
     guard_seconds = TIME_GUARD_MINUTES * 60.0
+    deadline = None
+    plan = plan_run(len(items))
+    print_plan(plan)
+    if limit_seconds is not None:
+        # No se arranca un ítem si su p90 ya no cabe antes del guard: el
+        # último ítem también puede traer minutos de backoff.
+        margin = plan["modelo"]["p90"]
+        deadline = start_time + max(0.0, limit_seconds - guard_seconds - margin)
+        # Un reintento sí puede usar el margen del p90; el guard no
+        run_deadline = start_time + max(0.0, limit_seconds - guard_seconds)
 
-    pending_items = []
-    stopped_by_time = False
+    controller = get_rate_controller()
+    print(f"🎚️ Tasa AIMD de arranque: {controller.rate:.2f} pet/min (límites {AIMD_MIN_RATE:g}–{aimd_max_rate():g}).")
 
-    for i, (kind, payload) in enumerate(items, 1):
-        if limit_seconds is not None:
-            elapsed = time.time() - start_time
-            if elapsed >= max(0.0, limit_seconds - guard_seconds):
-                horas_usadas = elapsed / 3600.0
+    csv_name = f"cyberpuerta_datos_loop{loop_index}{output_suffix()}.csv"
+    row_sink = CsvRowSink(csv_name)
+    # Lo ya terminado en arranques anteriores de la misma corrida se copia
+    # primero, así el CSV de cada loop trae la corrida completa hasta ahí.
+    for row in journal_final_rows():
+        row_sink.write(row)
+    if row_sink.count:
+        print(f"🗂️ {row_sink.count} filas ya terminadas de la corrida copiadas a '{csv_name}'.")
+    # Frescos y caché negativo: su última fila conocida, sin historial ni alertas
+    for kind, payload, row in known_rows:
+        journal_finish(kind, payload, row)
+        row_sink.write(row)
+    try:
+        if INPUT_CATEGORY_URLS and codes:
+            resolved = crawl_categories(codes, deadline)
+            for j, (code, row) in enumerate(resolved.items(), 1):
+                journal_finish("code", code, row)
+                report_row(j, len(resolved), code, row)
+                emit_row(row)
+            items = [(kind, payload) for (kind, payload) in items
+                     if not (kind == "code" and payload in resolved)]
+            total = len(items)
+            print(f"👉 Quedan {total} ítems para búsqueda individual.\n")
+
+        if WORKERS > 1:
+            _, skipped = run_concurrent(items, deadline)
+            if skipped:
                 print(
                     f"⏹️ Se alcanzó el límite de tiempo de {MAX_TOTAL_HOURS:.2f} horas.\n"
-                    f"   Se detiene en el ítem {i}/{total}. Lo que falta se guardará como pendientes."
+                    f"   Quedaron {len(skipped)}/{total} ítems sin procesar. Se guardarán como pendientes."
                 )
-                pending_items = items[i-1:]
-                stopped_by_time = True
-                break
+        else:
+            run_serial(items, deadline)
+    finally:
+        row_sink.close()
+        row_sink = None
+        close_alerts()
 
-        try:
-            if kind == "code":
-                row = process_code(payload)
-            else:
-                row = process_url(payload)
-            results.append(row)
-
-            print(f"[{i}/{total}] {payload} -> {row['STATUS']}")
-            print(row_to_tsv(row))
-            sys.stdout.flush()
-
-        except Exception as e:
-            row = {
-                "TIMESTAMP": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "SKU": payload if kind == "code" else "",
-                "URL_BUSQUEDA": BASE_SEARCH + quote_plus(payload) if kind == "code" else payload,
-                "URL_PRODUCTO": "",
-                "TITULO": "", "PRECIO_TEXTO": "", "PRECIO_NUM": "",
-                "STOCK_TEXTO": "", "STOCK_NUM": "", "STATUS": f"Error: {e}"
-            }
-            results.append(row)
-            print(f"[{i}/{total}] {payload} -> Error: {e}")
-            print(row_to_tsv(row))
-            sys.stdout.flush()
+    c = controller.counts
+    print(
+        f"🎚️ Tasa AIMD final: {controller.rate:.2f} pet/min "
+        f"({c['ok']} OK, {c['bloqueos']} bloqueos 429/403, {c['lentas']} lentas)."
+    )
+    if HTTP_CACHE:
+        st = http_cache_stats
+        ratio = st["no_modificado"] / st["detalle"] if st["detalle"] else 0.0
+        print(
+            f"🗄️ Caché HTTP: {st['detalle']} detalles, {st['condicionales']} condicionales, "
+            f"{st['no_modificado']} sin cambios (304, {ratio:.0%}), {st['completas']} completas."
+        )
+
+    reuse = product_pages.counts
+    if reuse["paginas_reusadas"]:
+        print(
+            f"🔗 Variantes con la misma página: {reuse['paginas_reusadas']} detalles reusados, "
+            f"{reuse['esperas_ahorradas']} esperas iniciales ahorradas."
+        )
+    if search_harvest.counts["urls_cosechadas"]:
+        print(f"🌾 Tarjetas de búsqueda: {search_harvest.counts['urls_cosechadas']} SKUs pendientes "
+              f"con URL tomada de la búsqueda de otro SKU.")
 
-    if not stopped_by_time:
-        pending_items = []
+    report_name = f"cyberpuerta_reporte_loop{loop_index}{output_suffix()}.json"
+    prom_name = os.path.join(METRICS_DIR, f"cyberpuerta_metricas{output_suffix()}.prom")
+    write_run_report(report_name, prom_name)
+    t = metrics.report()["tiempo_items"]
+    print(
+        f"⏱️ Tiempo de ítems: {t['total'] / 3600:.2f} h = espera {t['espera'] / 3600:.2f} h, "
+        f"backoff {t['backoff'] / 3600:.2f} h, trabajo {t['trabajo'] / 3600:.2f} h "
+        f"(red {t['red'] / 3600:.2f} h). Reporte: '{report_name}', métricas: '{prom_name}'."
+    )
 
+    pending_items = journal_open_items()
     pending_codes = [p for (k, p) in pending_items if k == "code"]
 
-    df = pd.DataFrame(results, columns=COLUMNS)
-    csv_name = f"cyberpuerta_datos_loop{loop_index}.csv"
-    xlsx_name = f"cyberpuerta_datos_loop{loop_index}.xlsx"
-
-    df.to_csv(csv_name, index=False, encoding="utf-8-sig")
-    with pd.ExcelWriter(xlsx_name, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False, sheet_name="Datos")
-        ws = writer.sheets["Datos"]
-        for col in ["URL_BUSQUEDA", "URL_PRODUCTO"]:
-            if col in df.columns:
-                c = df.columns.get_loc(col)
-                for r, val in enumerate(df[col].fillna(""), start=1):
-                    if isinstance(val, str) and val.startswith("http"):
-                        ws.write_url(r, c, val, string=val)
-
-    print(f"\n✅ LOOP {loop_index}: '{csv_name}' y '{xlsx_name}' generados.")
-
-    if pending_codes and loop_index < 3:
-        pending_file = f"cyberpuerta_pending_codes_loop{loop_index}.txt"
-        with open(pending_file, "w", encoding="utf-8") as f:
-            for code in pending_codes:
-                f.write(code + "\n")
-        print(
-            f"⚠️ Quedaron {len(pending_codes)} códigos pendientes en el loop {loop_index}.\n"
-            f"   Se guardaron en '{pending_file}' para el siguiente loop."
-        )
-    elif pending_codes and loop_index >= 3:
-        pending_file = f"cyberpuerta_pending_codes_loop{loop_index}.txt"
+    n_rows, outputs = export_outputs(csv_name)
+
+    generados = ", ".join(repr(p) for p in outputs.values())
+    print(f"\n✅ LOOP {loop_index}: {generados} generados ({n_rows} filas).")
+
+    delta_name = f"cyberpuerta_cambios_loop{loop_index}{output_suffix()}.csv"
+    delta_counts = write_delta_report(delta_name)
+    resumen = ", ".join(f"{n} {tipo}" for tipo, n in sorted(delta_counts.items())) or "sin cambios"
+    print(f"📈 Cambios contra corridas anteriores: {resumen} -> '{delta_name}'.")
+
+    if pending_items:
+        pending_file = f"cyberpuerta_pending_codes_loop{loop_index}{output_suffix()}.txt"
         with open(pending_file, "w", encoding="utf-8") as f:
             for code in pending_codes:
                 f.write(code + "\n")
         print(
-            f"⚠️ Loop 3 también llegó al límite de tiempo. Se guardaron {len(pending_codes)} pendientes "
-            f"en '{pending_file}', pero no habrá un cuarto loop automático."
+            f"⚠️ Quedaron {len(pending_items)} ítems abiertos en la corrida '{RUN_ID}' (loop {loop_index}).\n"
+            f"   Códigos en '{pending_file}'. Cualquier arranque siguiente (LOOP_INDEX={loop_index + 1} "
+            f"o re-ejecutar) continúa desde el journal."
         )
     else:
-        print(f"✅ LOOP {loop_index}: No quedaron códigos pendientes.")
+        print(f"✅ LOOP {loop_index}: No quedaron códigos pendientes en la corrida '{RUN_ID}'.")
+
+    return n_rows, outputs, delta_name
+
+
+# ================= Modo continuo (daemon) ===============================
+# En vez de un lote diario con fecha límite, `daemon` mantiene una agenda
+# ordenada por tiempo: cada ítem tiene su próxima visita y su intervalo de
+# refresco, y los vencidos salen al ritmo del control de tasa a cualquier
+# hora. Con el mismo presupuesto de peticiones los datos quedan repartidos
+# en el día en vez de tener 23 horas de antigüedad. Los SKUs que cambian
+# seguido se refrescan más que los estables (mismo puntaje que la
+# prioridad del modo lote). Las filas van al CSV del día conforme llegan;
+# al cambiar de día se exportan los demás formatos y el reporte de cambios.
+DAEMON_INTERVAL_HOURS = float(os.environ.get("CYBERPUERTA_INTERVALO_HORAS", "24"))
+DAEMON_MIN_FACTOR = 0.25      # el ítem más volátil se visita cada intervalo/4
+DAEMON_MAX_FACTOR = 2.0       # el más estable, cada 2 intervalos
+DAEMON_RETRY_MINUTES = 30.0   # primera revisita tras una falla; se dobla hasta el intervalo
+DAEMON_RESCORE_HOURS = 6.0    # cada cuánto se recalculan los intervalos
+DAEMON_REPORT_MINUTES = 10.0  # cada cuánto se reescriben el reporte JSON y el .prom
+DAEMON_COALESCE_MINUTES = 60.0  # una página de detalle se reusa entre variantes por este tiempo
+
+
+def refresh_interval(score):
+    """Intervalo de refresco (s) para un puntaje de priority_scores()."""
+    s = 1.0 if score == float("inf") else min(max(score, 0.0), 1.0)
+    factor = DAEMON_MAX_FACTOR - (DAEMON_MAX_FACTOR - DAEMON_MIN_FACTOR) * s
+    return DAEMON_INTERVAL_HOURS * 3600.0 * factor
+
+
+class Agenda:
+    """
+    Cola de ítems ordenada por próxima visita, guardada en la tabla
+    `agenda` para que un reinicio siga donde iba. `next_due()` entrega el
+    ítem más vencido y `reschedule()` lo vuelve a formar con su intervalo.
+    """
+
+    def __init__(self, items):
+        self.lock = threading.Lock()
+        self.intervals = {}
+        self.rescored = 0.0
+        now = time.time()
+        wanted = set(items)
+        with _db_lock:
+            db = get_db()
+            known = {
+                (kind, payload): (due, fails)
+                for kind, payload, due, fails in db.execute("SELECT tipo, valor, proxima, fallos FROM agenda")
+            }
+            new = [it for it in items if it not in known]
+            if PRIORITY_ENABLED and new:
+                new = prioritize_items(new)
+            with db:
+                db.executemany("DELETE FROM agenda WHERE tipo = ? AND valor = ?",
+                               [k for k in known if k not in wanted])
+                # Los nuevos vencen ya, en orden de prioridad
+                db.executemany(
+                    "INSERT INTO agenda (tipo, valor, proxima, intervalo) VALUES (?, ?, ?, ?)",
+                    [(kind, payload, now + j * 1e-3, DAEMON_INTERVAL_HOURS * 3600.0)
+                     for j, (kind, payload) in enumerate(new)],
+                )
+        self.heap = [(known[it][0], it[0], it[1]) for it in items if it in known]
+        self.heap += [(now + j * 1e-3, kind, payload) for j, (kind, payload) in enumerate(new)]
+        heapq.heapify(self.heap)
+        self.fails = {it: known[it][1] for it in items if it in known}
+        state = freshness_state([payload for _, payload in items]) if NEGATIVE_CACHE_ENABLED else {}
+        self.misses = {key: st[2] for key, st in state.items() if st[2]}
+        self.new = len(new)
+        self.rescore()
+
+    def rescore(self):
+        keys = [payload for _, _, payload in self.heap]
+        scores = priority_scores(keys)
+        with self.lock:
+            self.intervals = {key: refresh_interval(scores.get(key, float("inf"))) for key in keys}
+            self.rescored = time.time()
+        with _db_lock:
+            db = get_db()
+            with db:
+                db.executemany("UPDATE agenda SET intervalo = ? WHERE valor = ?",
+                               [(iv, key) for key, iv in self.intervals.items()])
+
+    def items_per_day(self):
+        return sum(86400.0 / iv for iv in self.intervals.values())
+
+    def next_due(self, stop, until=None):
+        """Saca el ítem más vencido; None si se pide parar o se llega a `until`."""
+        while not stop.is_set():
+            now = time.time()
+            if until is not None and now >= until:
+                return None
+            with self.lock:
+                if self.heap and self.heap[0][0] <= now:
+                    _, kind, payload = heapq.heappop(self.heap)
+                    return kind, payload
+                wait = self.heap[0][0] - now if self.heap else 60.0
+            if until is not None:
+                wait = min(wait, until - now)
+            # En tramos cortos para atender la señal de parada
+            stop.wait(min(max(wait, 0.0), 60.0))
+        return None
+
+    def reschedule(self, kind, payload, row):
+        now = time.time()
+        with self.lock:
+            interval = self.intervals.get(payload, DAEMON_INTERVAL_HOURS * 3600.0)
+            if _is_failure(row.get("STATUS")):
+                fails = self.fails.get((kind, payload), 0) + 1
+                delay = min(interval, DAEMON_RETRY_MINUTES * 60.0 * 2 ** (fails - 1))
+            else:
+                fails = 0
+                delay = interval
+                # Caché negativo: un SKU que sigue sin aparecer se revisa cada vez menos
+                if NEGATIVE_CACHE_ENABLED and _is_not_found(row.get("STATUS")):
+                    self.misses[payload] = self.misses.get(payload, 0) + 1
+                    delay = max(delay, negative_recheck_seconds(self.misses[payload]))
+                else:
+                    self.misses.pop(payload, None)
+            self.fails[(kind, payload)] = fails
+            # ±5% para que los ítems de un mismo arranque no sigan en bloque
+            due = now + delay * jitter(0.95, 1.05)
+            heapq.heappush(self.heap, (due, kind, payload))
+        with _db_lock:
+            db = get_db()
+            with db:
+                db.execute(
+                    "UPDATE agenda SET proxima = ?, fallos = ?, ultima = ? WHERE tipo = ? AND valor = ?",
+                    (due, fails, now, kind, payload),
+                )
+        return due
+
+
+class DailyOutput:
+    """
+    CSV del día en modo append mientras corre la sesión. Al cerrar, el CSV
+    se rehace desde el historial (el runner de la sesión anterior se llevó su
+    parte; el historial viaja en el estado) y se exporta. El correo del día
+    sale una sola vez: al cambiar de día dentro de la sesión o, si el día
+    terminó entre dos sesiones, al arrancar la siguiente (`catch_up`).
+    """
+
+    STATE_KEY = "continuo_reportado"
+
+    @staticmethod
+    def run_id(day):
+        # Con shards cada daemon lleva su propia corrida, como set_shard en modo lote
+        return f"continuo-{day}{run_id_suffix()}"
+
+    def __init__(self, email=True):
+        self.email = email
+        self.day = None
+        self.csv_name = None
+        self.lock = threading.Lock()
+
+    def emit(self, row):
+        global row_sink, RUN_ID
+        day = datetime.now().strftime("%Y-%m-%d")
+        with self.lock:
+            if day != self.day:
+                if self.day is not None:
+                    self.close(final=True)
+                self.day = day
+                RUN_ID = self.run_id(day)
+                self.csv_name = f"cyberpuerta_continuo_{day}{output_suffix()}.csv"
+                row_sink = CsvRowSink(self.csv_name, append=True)
+                print(f"🗓️ Día {day}: filas a '{self.csv_name}' (corrida '{RUN_ID}').")
+            emit_row(row)
+
+    def close(self, final=False):
+        """Exporta el día en curso; `final` además lo reporta (correo del día)."""
+        global row_sink
+        if row_sink is None:
+            return
+        row_sink.close()
+        row_sink = None
+        self.finish(self.day, final)
+
+    def finish(self, day, final):
+        csv_name = f"cyberpuerta_continuo_{day}{output_suffix()}.csv"
+        run_id = self.run_id(day)
+        sink = CsvRowSink(csv_name)
+        try:
+            for row in run_history_rows(run_id):
+                sink.write(row)
+        finally:
+            sink.close()
+        n, outputs = export_outputs(csv_name)
+        delta_name = f"cyberpuerta_cambios_{day}{output_suffix()}.csv"
+        counts = write_delta_report(delta_name, run_id)
+        resumen = ", ".join(f"{k} {tipo}" for tipo, k in sorted(counts.items())) or "sin cambios"
+        print(f"📈 Día {day}: {n} filas, cambios: {resumen} -> '{delta_name}'.")
+        if not final:
+            return
+        if self.email:
+            _send_email_if_configured(
+                [delta_name] + (list(outputs.values()) if EMAIL_FULL_FILES else []),
+                f"Día {day}: {n} filas, cambios contra visitas anteriores: {resumen}.",
+            )
+        with _db_lock:
+            db = get_db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO estado (clave, valor, actualizado) VALUES (?, ?, ?)",
+                    (self.STATE_KEY, day, time.time()),
+                )
+
+    def catch_up(self):
+        """
+        Reporta los días anteriores a hoy que quedaron sin reportar. Sin
+        marca previa (primer arranque) sólo el más reciente.
+        """
+        today = datetime.now().strftime("%Y-%m-%d")
+        with _db_lock:
+            db = get_db()
+            row = db.execute("SELECT valor FROM estado WHERE clave = ?", (self.STATE_KEY,)).fetchone()
+            runs = [corrida for (corrida,) in db.execute(
+                "SELECT DISTINCT corrida FROM historial WHERE corrida LIKE 'continuo-%'"
+            )]
+        # continuo-AAAA-MM-DD[-shardIofN]: sólo los días de este shard
+        days = sorted(run[9:19] for run in runs if run == self.run_id(run[9:19]))
+        last = row[0] if row else None
+        pending = [d for d in days if d < today and (last is None or d > last)]
+        for day in pending if last is not None else pending[-1:]:
+            print(f"🗓️ El día {day} terminó entre sesiones: se cierra y se reporta ahora.")
+            self.finish(day, final=True)
+
+
+def run_daemon(max_hours=None, email=True):
+    """
+    Atiende la agenda hasta que llegue SIGTERM/Ctrl+C o pasen `max_hours`
+    (0/None = sin límite). Devuelve las filas emitidas.
+    """
+    global rate_limiter, run_deadline
+    items = [("code", c) for c in input_codes()] + [("url", u) for u in input_urls()]
+    items = [(kind, payload) for (kind, payload) in items if in_shard(payload)]
+    agenda = Agenda(items)
+    product_pages.reset(max_age=DAEMON_COALESCE_MINUTES * 60.0)
+    per_item = item_duration_model()["media"]
+    capacity = 86400.0 / per_item if per_item > 0 else float("inf")
+    demand = agenda.items_per_day()
+    print(
+        f"🛰️ Modo continuo: {len(items)} ítems ({agenda.new} nuevos en la agenda), "
+        f"{demand:.0f} visitas/día pedidas, capacidad ~{capacity:.0f}/día a {per_item:.0f}s por ítem."
+    )
+    if demand > capacity:
+        print("⚠️ La agenda pide más visitas de las que caben: los ítems se atenderán con retraso, "
+              "el más vencido primero (sube CYBERPUERTA_INTERVALO_HORAS o agrega shards).")
+
+    stop = threading.Event()
+    until = time.time() + max_hours * 3600.0 if max_hours else None
+    run_deadline = until
+
+    def on_signal(signum, frame):
+        print(f"🛑 Señal {signum}: se termina el ítem en curso y se sale.")
+        stop.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, on_signal)
+
+    controller = get_rate_controller()
+    if WORKERS > 1:
+        rate_limiter = TokenBucket(controller.rate, RATE_BURST, controller=controller)
+    output = DailyOutput(email)
+    output.catch_up()
+    report_name = f"cyberpuerta_reporte_continuo{output_suffix()}.json"
+    prom_name = os.path.join(METRICS_DIR, f"cyberpuerta_metricas{output_suffix()}.prom")
+    state = {"n": 0, "report": time.monotonic()}
+    state_lock = threading.Lock()
+
+    def work():
+        while True:
+            item = agenda.next_due(stop, until)
+            if item is None:
+                return
+            kind, payload = item
+            row = run_item(kind, payload)
+            due = agenda.reschedule(kind, payload, row)
+            output.emit(row)
+            with state_lock:
+                state["n"] += 1
+                n = state["n"]
+                write_report = time.monotonic() - state["report"] >= DAEMON_REPORT_MINUTES * 60.0
+                if write_report:
+                    state["report"] = time.monotonic()
+            report_row(n, len(items), payload, row)
+            print(f"   ⏭️ Próxima visita: {datetime.fromtimestamp(due).strftime('%Y-%m-%d %H:%M')}")
+            if write_report:
+                write_run_report(report_name, prom_name)
+            if time.time() - agenda.rescored >= DAEMON_RESCORE_HOURS * 3600.0:
+                agenda.rescore()
 
-    return df, csv_name, xlsx_name
+    try:
+        if WORKERS > 1:
+            threads = [threading.Thread(target=work, daemon=True) for _ in range(WORKERS)]
+            for t in threads:
+                t.start()
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(1.0)
+        else:
+            work()
+    except KeyboardInterrupt:
+        print("🛑 Interrumpido: se cierra el día en curso.")
+        stop.set()
+    finally:
+        rate_limiter = None
+        with output.lock:
+            output.close()
+        close_alerts()
+        write_run_report(report_name, prom_name)
+    print(f"✅ Modo continuo: {state['n']} ítems atendidos. Reporte: '{report_name}'.")
+    return state["n"]
+
+
+def enviar_alerta_por_mail(sender: str, password: str, recipient: str, alert: dict):
+    import smtplib
+    import ssl
+    from email.message import EmailMessage
+
+    msg = EmailMessage()
+    msg["Subject"] = f"Alerta Cyberpuerta: {alert['SKU']} ({alert['TIPO']})"
+    msg["From"] = sender
+    msg["To"] = recipient
+    msg.set_content(f"{alert['MENSAJE']}\n\n{alert['URL_PRODUCTO']}\n")
+    context = ssl.create_default_context()
+    with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
+        server.login(sender, password)
+        server.send_message(msg)
 
 
 def enviar_resultados_por_mail(
     sender: str,
     password: str,
     recipient: str,
-    archivos_adjuntos=None
+    archivos_adjuntos=None,
+    resumen=None,
 ):
+    import smtplib
+    import ssl
+    from email.message import EmailMessage
+
     if archivos_adjuntos is None:
         archivos_adjuntos = []
 
@@ -712,7 +3946,8 @@ def enviar_resultados_por_mail(
     cuerpo = (
         "Hola Abraham,\n\n"
         "Te mando los archivos generados hoy por el scraper de Cyberpuerta.\n\n"
-        "Saludos."
+        + (f"{resumen}\n\n" if resumen else "")
+        + "Saludos."
     )
     msg.set_content(cuerpo)
 
@@ -738,20 +3973,295 @@ def enviar_resultados_por_mail(
     print("✅ Correo enviado correctamente.")
 
 
-if __name__ == "__main__":
-    print(f"🔁 Iniciando scraper – LOOP_INDEX = {LOOP_INDEX}")
-    df, csv_name, xlsx_name = main(loop_index=LOOP_INDEX)
+# ================= Configuración y CLI ==================================
+def configure(*, codes=None, urls=None, category_urls=None, max_hours=None, guard_minutes=None,
+              workers=None, outputs=None, base_url=None, run_id=None, shard=None, archive_dir=None,
+              refresh_hours=None, alert_rules=None, fresh_ttl_hours=None):
+    """
+    Ajusta la configuración del módulo (lo mismo que las variables de
+    entorno), para la CLI o para usarlo como biblioteca desde otros jobs.
+    Sólo cambia lo que no sea None; llámese antes de main().
+    """
+    global INPUT_CODES, INPUT_URLS, INPUT_CATEGORY_URLS, MAX_TOTAL_HOURS, TIME_GUARD_MINUTES
+    global WORKERS, OUTPUTS, BASE_URL, BASE_SEARCH, RUN_ID, ARCHIVE_DIR, DAEMON_INTERVAL_HOURS
+    global ALERT_RULES_PATH, FRESH_TTL_HOURS
+    if outputs is not None:
+        unknown = set(outputs) - set(OUTPUT_FORMATS)
+        if unknown:
+            raise ValueError(f"formato(s) desconocido(s): {', '.join(sorted(unknown))}")
+        OUTPUTS = list(outputs)
+    if codes is not None:
+        INPUT_CODES = "\n".join(c.strip() for c in codes if c.strip())
+    if urls is not None:
+        INPUT_URLS = list(urls)
+    if category_urls is not None:
+        INPUT_CATEGORY_URLS = list(category_urls)
+    if max_hours is not None:
+        MAX_TOTAL_HOURS = max_hours
+    if guard_minutes is not None:
+        TIME_GUARD_MINUTES = guard_minutes
+    if workers is not None:
+        WORKERS = max(1, workers)
+    if base_url is not None:
+        BASE_URL = base_url.rstrip("/")
+        BASE_SEARCH = f"{BASE_URL}/index.php?cl=search&searchparam="
+        if _session is not None:
+            _session.headers["Referer"] = f"{BASE_URL}/"
+    if run_id is not None:
+        RUN_ID = run_id
+    if shard is not None:
+        set_shard(shard)
+    if archive_dir is not None:
+        ARCHIVE_DIR = archive_dir
+    if fresh_ttl_hours is not None:
+        FRESH_TTL_HOURS = max(0.0, fresh_ttl_hours)
+    if alert_rules is not None:
+        if alert_rules:
+            load_alert_rules(alert_rules)   # falla aquí y no a media corrida
+        ALERT_RULES_PATH = alert_rules
+    if refresh_hours is not None:
+        if refresh_hours <= 0:
+            raise ValueError("el intervalo de refresco debe ser mayor que 0")
+        DAEMON_INTERVAL_HOURS = refresh_hours
 
-    EMAIL_SENDER = os.environ.get("EMAIL_SENDER")
-    EMAIL_PASSWORD = os.environ.get("EMAIL_PASSWORD")
-    EMAIL_TO = os.environ.get("EMAIL_TO")
 
-    if EMAIL_SENDER and EMAIL_PASSWORD and EMAIL_TO:
+def _read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [ln.strip() for ln in f if ln.strip()]
+
+
+def _send_email_if_configured(adjuntos, resumen=None):
+    sender = os.environ.get("EMAIL_SENDER")
+    password = os.environ.get("EMAIL_PASSWORD")
+    recipient = os.environ.get("EMAIL_TO")
+    if sender and password and recipient:
         enviar_resultados_por_mail(
-            sender=EMAIL_SENDER,
-            password=EMAIL_PASSWORD,
-            recipient=EMAIL_TO,
-            archivos_adjuntos=[csv_name, xlsx_name],
+            sender=sender,
+            password=password,
+            recipient=recipient,
+            archivos_adjuntos=adjuntos,
+            resumen=resumen,
+        )
+        return True
+    print("ℹ️ Email no configurado (EMAIL_SENDER / EMAIL_PASSWORD / EMAIL_TO). No se envía correo.")
+    return False
+
+
+def _apply_run_args(ap, args):
+    try:
+        configure(
+            codes=_read_lines(args.codigos) if args.codigos else None,
+            max_hours=args.max_horas,
+            guard_minutes=args.guard_min,
+            workers=args.workers,
+            outputs=[f.strip() for f in args.salidas.split(",") if f.strip()] if args.salidas else None,
+            run_id=getattr(args, "corrida", None),
+            shard=parse_shard(args.shard) if args.shard else None,
+            archive_dir=args.archivo,
+            alert_rules=args.alertas,
+            fresh_ttl_hours=args.frescura_horas,
+        )
+    except (ValueError, OSError) as e:
+        ap.error(str(e))
+
+
+def _run_and_report(loop_index, email):
+    print(f"🔁 Iniciando scraper – LOOP_INDEX = {loop_index}" + (f" – shard {SHARD[0]}/{SHARD[1]}" if SHARD else ""))
+    n_rows, outputs, delta_name = main(loop_index=loop_index)
+    with open(delta_name, encoding="utf-8-sig") as f:
+        n_cambios = sum(1 for _ in f) - 1
+    if email:
+        # Por defecto sólo viaja el reporte de cambios; los archivos completos
+        # quedan como artefactos del workflow.
+        adjuntos = [delta_name]
+        if EMAIL_FULL_FILES:
+            adjuntos += list(outputs.values())
+        resumen = f"Cambios contra la corrida anterior: {n_cambios} (ver '{delta_name}'). Filas totales: {n_rows}."
+        _send_email_if_configured(adjuntos, resumen)
+    return 0
+
+
+def cmd_scrape(ap, args):
+    _apply_run_args(ap, args)
+    if args.dry_run:
+        items, _ = skip_known_items(planned_items(args.loop))
+        n_codes = sum(1 for kind, _ in items if kind == "code")
+        print(f"📋 Por visitar: {n_codes} códigos y {len(items) - n_codes} URLs.")
+        print_plan(plan_run(len(items)))
+        return 0
+    return _run_and_report(args.loop, not args.sin_email)
+
+
+def cmd_resume(ap, args):
+    _apply_run_args(ap, args)
+    counts = journal_counts()
+    if not counts:
+        print(f"⚠️ La corrida '{RUN_ID}' no tiene journal; no hay nada que reanudar (usa 'scrape').")
+        return 1
+    if not journal_open_items():
+        print(f"✅ La corrida '{RUN_ID}' ya no tiene ítems abiertos.")
+        return 0
+    return _run_and_report(args.loop, not args.sin_email)
+
+
+def cmd_daemon(ap, args):
+    _apply_run_args(ap, args)
+    try:
+        configure(refresh_hours=args.intervalo_horas)
+    except ValueError as e:
+        ap.error(str(e))
+    run_daemon(max_hours=args.max_horas, email=not args.sin_email)
+    return 0
+
+
+def cmd_merge(ap, args):
+    if args.salidas:
+        try:
+            configure(outputs=[f.strip() for f in args.salidas.split(",") if f.strip()])
+        except ValueError as e:
+            ap.error(str(e))
+    try:
+        outputs = merge_shards(args.csv or None)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"❌ {e}")
+        return 1
+    if not args.sin_email:
+        _send_email_if_configured(list(outputs.values()))
+    return 0
+
+
+def cmd_report(ap, args):
+    run_id = args.corrida or RUN_ID
+    counts = journal_counts(run_id)
+    if counts:
+        resumen = ", ".join(f"{n} {estado}" for estado, n in sorted(counts.items()))
+        print(f"🗂️ Corrida '{run_id}': {resumen}.")
+    else:
+        print(f"ℹ️ La corrida '{run_id}' no tiene journal.")
+    path = args.salida or f"cyberpuerta_cambios_{run_id}.csv"
+    delta_counts = write_delta_report(path, run_id)
+    resumen = ", ".join(f"{n} {tipo}" for tipo, n in sorted(delta_counts.items())) or "sin cambios"
+    print(f"📈 Cambios contra corridas anteriores: {resumen} -> '{path}'.")
+    return 0
+
+
+def cmd_reextract(ap, args):
+    try:
+        configure(
+            archive_dir=args.archivo,
+            outputs=[f.strip() for f in args.salidas.split(",") if f.strip()] if args.salidas else None,
         )
+    except ValueError as e:
+        ap.error(str(e))
+    if not ARCHIVE_DIR:
+        ap.error("falta la carpeta del archivo (--archivo o CYBERPUERTA_ARCHIVO)")
+    n, outputs = reextract(
+        out_base=args.salida,
+        since=args.desde,
+        until=args.hasta,
+        keys=_read_lines(args.codigos) if args.codigos else None,
+        latest=args.ultimo,
+        processes=args.procesos,
+    )
+    print(f"✅ {n} filas reextraídas: {', '.join(outputs.values())}")
+    return 0
+
+
+def cmd_email(ap, args):
+    return 0 if _send_email_if_configured(args.archivos, args.resumen) else 1
+
+
+def cmd_bench(ap, args):
+    if args.cual == "parsers":
+        import bench_parsers as bench
     else:
-        print("ℹ️ Email no configurado (EMAIL_SENDER / EMAIL_PASSWORD / EMAIL_TO). No se envía correo.")
+        import bench_pipeline as bench
+    return bench.main(args.args)
+
+
+def _add_run_options(p, loop=True):
+    p.add_argument("--shard", default=os.environ.get("CYBERPUERTA_SHARD"),
+                   help="procesa sólo el shard i de N, p. ej. 2/4 (o CYBERPUERTA_SHARD)")
+    p.add_argument("--codigos", metavar="ARCHIVO", help="archivo con un SKU por línea (en vez de INPUT_CODES)")
+    p.add_argument("--max-horas", type=float, help="sustituye CYBERPUERTA_MAX_HOURS")
+    p.add_argument("--guard-min", type=float, help="sustituye CYBERPUERTA_GUARD_MINUTES")
+    p.add_argument("--workers", type=int, help="sustituye CYBERPUERTA_WORKERS")
+    p.add_argument("--salidas", help=f"formatos separados por coma: {', '.join(OUTPUT_FORMATS)} "
+                                     "(o CYBERPUERTA_SALIDAS; el CSV siempre se escribe)")
+    p.add_argument("--archivo", metavar="CARPETA", help="guarda las páginas crudas ahí (o CYBERPUERTA_ARCHIVO)")
+    p.add_argument("--alertas", metavar="JSON", help="reglas de alerta (o CYBERPUERTA_ALERTAS)")
+    p.add_argument("--frescura-horas", type=float,
+                   help="no visita los SKUs con OK más reciente que esto (o CYBERPUERTA_FRESCURA_HORAS; 0 = nunca)")
+    if loop:
+        p.add_argument("--loop", type=int, default=LOOP_INDEX, help="número de loop (o LOOP_INDEX)")
+        p.add_argument("--sin-email", action="store_true", help="no manda el correo al terminar")
+
+
+def cli(argv=None):
+    ap = argparse.ArgumentParser(
+        prog="scraper_cyberpuerta.py",
+        description="Scraper de precios y stock de Cyberpuerta. Sin subcomando equivale a 'scrape'.",
+    )
+    sub = ap.add_subparsers(dest="cmd", metavar="{scrape,resume,daemon,merge,report,reextract,email,bench}")
+
+    p = sub.add_parser("scrape", help="corre un loop (continúa el journal de la corrida si ya existe)")
+    _add_run_options(p)
+    p.add_argument("--dry-run", action="store_true",
+                   help="sólo estima la duración (sin red) para la lista de SKUs y los tiempos dados")
+    p.set_defaults(func=cmd_scrape)
+
+    p = sub.add_parser("resume", help="continúa una corrida interrumpida desde su journal")
+    _add_run_options(p)
+    p.add_argument("--corrida", help="id de la corrida (por defecto la actual)")
+    p.set_defaults(func=cmd_resume)
+
+    p = sub.add_parser("daemon", help="modo continuo: agenda por SKU y peticiones repartidas en todo el día")
+    _add_run_options(p, loop=False)
+    p.add_argument("--intervalo-horas", type=float,
+                   help=f"intervalo base de refresco por SKU (o CYBERPUERTA_INTERVALO_HORAS; {DAEMON_INTERVAL_HOURS:g})")
+    p.add_argument("--sin-email", action="store_true", help="no manda el correo de cada día")
+    p.set_defaults(func=cmd_daemon)
+
+    p = sub.add_parser("merge", help="combina los CSV de los shards y revisa cobertura")
+    p.add_argument("csv", nargs="*", help="CSVs de los shards (por defecto los del loop más alto)")
+    p.add_argument("--salidas", help="formatos a generar además del CSV")
+    p.add_argument("--sin-email", action="store_true", help="no manda el correo al terminar")
+    p.set_defaults(func=cmd_merge)
+
+    p = sub.add_parser("report", help="reporte de cambios de una corrida a partir del historial")
+    p.add_argument("--corrida", help="id de la corrida (por defecto la actual)")
+    p.add_argument("--salida", metavar="CSV", help="archivo de salida")
+    p.set_defaults(func=cmd_report)
+
+    p = sub.add_parser("reextract", help="vuelve a extraer los campos de las páginas archivadas, sin red")
+    p.add_argument("--archivo", metavar="CARPETA", help="carpeta del archivo (o CYBERPUERTA_ARCHIVO)")
+    p.add_argument("--desde", metavar="AAAA-MM-DD", help="primera fecha de captura")
+    p.add_argument("--hasta", metavar="AAAA-MM-DD", help="última fecha de captura")
+    p.add_argument("--codigos", metavar="ARCHIVO", help="sólo los SKUs (o URLs) de este archivo")
+    p.add_argument("--ultimo", action="store_true", help="sólo la captura más reciente de cada producto")
+    p.add_argument("--procesos", type=int, help="procesos en paralelo (por defecto, uno por núcleo)")
+    p.add_argument("--salida", default="cyberpuerta_reextraido", help="nombre base de los archivos de salida")
+    p.add_argument("--salidas", help="formatos a generar además del CSV")
+    p.set_defaults(func=cmd_reextract)
+
+    p = sub.add_parser("email", help="manda archivos por correo con EMAIL_SENDER / EMAIL_PASSWORD / EMAIL_TO")
+    p.add_argument("archivos", nargs="+")
+    p.add_argument("--resumen", help="texto para el cuerpo del correo")
+    p.set_defaults(func=cmd_email)
+
+    p = sub.add_parser("bench", help="benchmarks: parsers (fixtures) o pipeline (sitio simulado)")
+    p.add_argument("cual", choices=["parsers", "pipeline"])
+    p.add_argument("args", nargs=argparse.REMAINDER, help="opciones del benchmark")
+    p.set_defaults(func=cmd_bench)
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] == ["--merge"]:
+        argv = ["merge"] + argv[1:]
+    elif not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv = ["scrape"] + argv
+    args = ap.parse_args(argv)
+    return args.func(ap, args)
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
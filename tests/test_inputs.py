@@ -0,0 +1,20 @@
+import scraper_cyberpuerta as sc
+
+
+def test_unique_codes_keeps_spaces_in_multiword_models():
+    codes = sc.unique_codes([
+        "AORUS 15 9MF-E2LA583",
+        "  ASUS ROG STRIX   LC III 360 ARGB ",
+        "SDCS2/128GB",
+        "sdcs2/ 128GB",
+        "",
+        "   ",
+    ])
+    assert codes == ["AORUS 15 9MF-E2LA583", "ASUS ROG STRIX LC III 360 ARGB", "SDCS2/128GB"]
+
+
+def test_input_codes_query_keeps_spaces():
+    codes = sc.input_codes()
+    for code in codes:
+        assert code == " ".join(code.split())
+    assert len({sc.norm_sku(c) for c in codes}) == len(codes)
@@ -0,0 +1,62 @@
+"""
+Salida de los parsers sobre fixtures/ contra fixtures/esperado.json, y
+equivalencia entre niveles de extracción. Es la misma verificación que
+`bench_parsers.py --solo-verificar`, pero caso por caso para pytest.
+"""
+import json
+
+import pytest
+
+import bench_parsers
+import scraper_cyberpuerta as sc
+
+PAGES = bench_parsers.load_fixtures()
+DETAIL_PAGES = [name for name in PAGES if name.startswith("detalle_")]
+# Páginas sin elementos: libxml2 no arma árbol y close() devuelve None
+EMPTY_PAGES = ["", "   ", " \n\t", "<!-- x -->", "  <!-- sólo un comentario -->  "]
+EMPTY_FIELDS = ("", "", None, "", "")
+
+
+@pytest.fixture(scope="module")
+def expected():
+    with open(bench_parsers.EXPECTED_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("name", sorted(PAGES))
+def test_fixture_output(name, expected):
+    assert name in expected, "sin salida esperada (corre bench_parsers.py --actualizar)"
+    assert bench_parsers.parse_fixture(name, PAGES[name]) == expected[name]
+
+
+@pytest.mark.parametrize("name", DETAIL_PAGES)
+def test_lxml_matches_soup(name):
+    html = PAGES[name]
+    _, fast = sc._extract_all_from_product_lxml(html)
+    assert fast == sc._extract_all_from_product_soup(html)
+
+
+@pytest.mark.parametrize("html", EMPTY_PAGES)
+def test_empty_detail_page(html):
+    assert sc.extract_all_from_product(html) == EMPTY_FIELDS
+    assert sc._extract_all_from_product_soup(html) == EMPTY_FIELDS
+
+
+@pytest.mark.parametrize("html", EMPTY_PAGES)
+def test_empty_listing_page(html):
+    # Un listado en blanco no debe tirar la corrida desde crawl_categories
+    assert sc.parse_listing_products(html, bench_parsers.SEARCH_BASE_URL) == []
+    assert sc.parse_next_page_url(html, bench_parsers.SEARCH_BASE_URL) is None
+    assert sc.parse_first_product_url_from_search(html, bench_parsers.SEARCH_BASE_URL) is None
+
+
+@pytest.mark.parametrize("text, value", [
+    ("$1,299.00", 1299.0),
+    ("$ 89.00 MXN", 89.0),
+    ("1199.00", 1199.0),
+    ("$\xa0199.00", 199.0),
+    ("", None),
+    ("Consultar", None),
+])
+def test_to_number(text, value):
+    assert sc.to_number(text) == value